@@ -4,67 +4,366 @@ import json
 from datetime import datetime, timedelta
 from pathlib import Path
 import threading
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Set, Iterator
 import os
-import traceback # For detailed error logging
+import itertools
+import functools
+import contextlib
+import shutil
+import time
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson # Optional: decodes cached geometry/properties several times faster than json
+    _json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    _json_loads = json.loads
+
+# Relative db_path arguments are anchored here; resolved once at import instead of per instance
+_PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent
+
+# External-content FTS5 index over shapes. The trigram tokenizer indexes every 3-character
+# substring, so MATCH finds infix matches ("out" -> "Router") and non-Latin (e.g. CJK) names,
+# and LIKE '%term%' on shapes_fts can use the index too. Terms shorter than 3 characters
+# cannot be answered from a trigram index. Changing this definition triggers a rebuild on startup.
+_FTS_TABLE_SQL = """CREATE VIRTUAL TABLE IF NOT EXISTS shapes_fts USING fts5(
+    name, stencil_path, content='shapes', content_rowid='id',
+    tokenize='trigram'
+)"""
+# iterdump() statements _recover_database does not replay: its own BEGIN/COMMIT (the replay runs in
+# _transaction) and the FTS5 virtual table with its shadow tables, which are recreated and rebuilt instead
+_DUMP_SKIP_RE = re.compile(r"""(?:BEGIN TRANSACTION|COMMIT|PRAGMA writable_schema|INSERT INTO sqlite_master\(.*'shapes_fts'"""
+                           r"""|CREATE TABLE 'shapes_fts_|INSERT INTO "shapes_fts)""")
+# Triggers keeping shapes_fts in sync with shapes, by name so one can be dropped and recreated on its own
+_FTS_TRIGGERS_SQL = {
+    'shapes_ai': """CREATE TRIGGER IF NOT EXISTS shapes_ai AFTER INSERT ON shapes BEGIN
+                    INSERT INTO shapes_fts(rowid, name, stencil_path) VALUES (new.id, new.name, new.stencil_path); END""",
+    'shapes_ad': """CREATE TRIGGER IF NOT EXISTS shapes_ad AFTER DELETE ON shapes BEGIN
+                    INSERT INTO shapes_fts(shapes_fts, rowid, name, stencil_path) VALUES ('delete', old.id, old.name, old.stencil_path); END""",
+    'shapes_au': """CREATE TRIGGER IF NOT EXISTS shapes_au AFTER UPDATE ON shapes BEGIN
+                    INSERT INTO shapes_fts(shapes_fts, rowid, name, stencil_path) VALUES ('delete', old.id, old.name, old.stencil_path);
+                    INSERT INTO shapes_fts(rowid, name, stencil_path) VALUES (new.id, new.name, new.stencil_path); END""",
+}
+# collections.shape_count is kept current by these, so get_collections needs no join or GROUP BY;
+# FK cascades (deleted shapes or stencils) fire the delete trigger too
+_COLLECTION_TRIGGERS_SQL = {
+    'collection_shapes_ai': """CREATE TRIGGER IF NOT EXISTS collection_shapes_ai AFTER INSERT ON collection_shapes BEGIN
+                    UPDATE collections SET shape_count = shape_count + 1 WHERE id = new.collection_id; END""",
+    'collection_shapes_ad': """CREATE TRIGGER IF NOT EXISTS collection_shapes_ad AFTER DELETE ON collection_shapes BEGIN
+                    UPDATE collections SET shape_count = shape_count - 1 WHERE id = old.collection_id; END""",
+}
+# Default ORDER BY rank for shapes_fts: a name hit outweighs a stencil_path hit
+_FTS_RANK = "bm25(10.0, 1.0)"
+
+# Without an explicit request, the startup integrity check re-runs at most this often (seconds)
+_INTEGRITY_CHECK_INTERVAL = 24 * 60 * 60
+
+# With filters, search_shapes ranks this many FTS candidates per requested result before filtering
+_FTS_FILTER_OVERFETCH = 10
+
+# Refresh planner statistics (sqlite_stat1) after this many stencils have been (re)cached
+_ANALYZE_EVERY_STENCILS = 500
+
+# Stored in PRAGMA user_version once the schema is current; bump it when _run_migrations gains a step
+_SCHEMA_VERSION = 4
+
+# Hot-path statements, shared so each connection's statement cache holds one compiled copy
+# ON CONFLICT ... DO UPDATE keeps existing rows (and their ids); INSERT OR REPLACE would delete the stencil
+# row first, cascading away its shapes and every favorite/collection entry pointing at them
+_SQL_UPSERT_STENCIL = """
+    INSERT INTO stencils
+    (path, name, extension, shape_count, file_size, last_scan, last_modified)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(path) DO UPDATE SET name = excluded.name, extension = excluded.extension,
+        shape_count = excluded.shape_count, file_size = excluded.file_size,
+        last_scan = excluded.last_scan, last_modified = excluded.last_modified
+"""
+# Only shapes no longer in the stencil are deleted; the second parameter is a JSON array of current names
+_SQL_DELETE_REMOVED_SHAPES = "DELETE FROM shapes WHERE stencil_path = ? AND name NOT IN (SELECT value FROM json_each(?))"
+# Unchanged shapes are skipped by the WHERE, so a rescan of an unchanged stencil fires no FTS triggers
+_SQL_UPSERT_SHAPE = """
+    INSERT INTO shapes (stencil_path, name, width, height, geometry, properties)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(stencil_path, name) DO UPDATE SET width = excluded.width, height = excluded.height,
+        geometry = excluded.geometry, properties = excluded.properties
+    WHERE shapes.width IS NOT excluded.width OR shapes.height IS NOT excluded.height
+        OR shapes.geometry IS NOT excluded.geometry OR shapes.properties IS NOT excluded.properties
+"""
+# Shape id lists are bound as one JSON array, so each statement text is the same for any list length
+# and stays in the connection's statement cache
+_SQL_ADD_COLLECTION_SHAPES = """
+    INSERT OR IGNORE INTO collection_shapes (collection_id, shape_id)
+    SELECT ?, id FROM shapes WHERE id IN (SELECT value FROM json_each(?))
+"""
+_SQL_REMOVE_COLLECTION_SHAPES = "DELETE FROM collection_shapes WHERE collection_id = ? AND shape_id IN (SELECT value FROM json_each(?))"
+# Collection timestamps are produced by SQLite in the same local ISO-8601 form datetime.now().isoformat() gives
+_SQL_NOW = "strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime')"
+_SQL_TOUCH_COLLECTION = f"UPDATE collections SET updated_at = {_SQL_NOW} WHERE id = ?"
+# stencils.last_modified is the file mtime in whole Unix seconds; readers get it back in local ISO-8601 form
+_SQL_LAST_MODIFIED_ISO = "strftime('%Y-%m-%dT%H:%M:%S', last_modified, 'unixepoch', 'localtime') AS last_modified"
+_SQL_GET_STENCIL = f"SELECT path, name, extension, shape_count, file_size, last_scan, {_SQL_LAST_MODIFIED_ISO} FROM stencils WHERE path = ?"
+_SQL_GET_STENCIL_SHAPES = "SELECT id as shape_id, name, width, height FROM shapes WHERE stencil_path = ?"
+_SQL_IS_FRESH = "SELECT 1 FROM stencils WHERE path = ? AND last_modified >= ?"
+_SQL_ALL_MTIMES = "SELECT path, last_modified FROM stencils"
+_SQL_MTIMES_FOR_PATHS = "SELECT path, last_modified FROM stencils WHERE path IN (SELECT value FROM json_each(?))"
+
+# FTS5 query syntax: a term using any of it is passed through as a query, everything else is quoted
+_FTS_SYNTAX_RE = re.compile(r'[()*^:]|\b(?:AND|OR|NOT|NEAR)\b')
+
+def _is_fts_syntax(term: str) -> bool:
+    """True for input with balanced quotes or FTS operators/parentheses (the explorer's AND/OR queries)."""
+    return term.count('"') % 2 == 0 and ('"' in term or bool(_FTS_SYNTAX_RE.search(term)))
+
+def _fts_can_match(term: str) -> bool:
+    """
+    Whether trigram MATCH can answer a search term: every word of plain input needs 3+ characters, as a
+    shorter one never matches ("PC 1"). Such terms go to LIKE instead; FTS syntax is always left to MATCH.
+    """
+    return _is_fts_syntax(term) or all(len(word) >= 3 for word in term.split())
+
+def _fts_match_query(term: str) -> str:
+    """
+    MATCH expression for a search term. Plain input is quoted word by word (quotes doubled), so '12" Rack'
+    or 'wi-fi' match literally instead of failing to parse and falling back to a scan; words are still ANDed.
+    Input with balanced quotes or FTS operators/parentheses (the explorer's AND/OR queries) keeps its syntax.
+    """
+    if _is_fts_syntax(term):
+        return term
+    return " ".join('"' + word.replace('"', '""') + '"' for word in term.split())
+
+@functools.lru_cache(maxsize=128)
+def _build_search_query(mode: str, filter_clauses: tuple, with_total: bool = False, with_highlights: bool = True) -> str:
+    """
+    SQL for search_shapes for one branch/filter combination. Identical text on repeated
+    searches also lets each connection's statement cache skip re-preparing it.
+    mode: 'fts' (MATCH), 'like' (substring via the trigram index), 'all' (no search term),
+    or 'scan' (LIKE on shapes, only when shapes_fts is unavailable).
+    with_total adds COUNT(*) OVER (): the number of matches before LIMIT/OFFSET, on every row.
+    with_highlights=False leaves highlighted_name NULL in 'fts' mode, sparing highlight() its per-row re-tokenizing.
+    """
+    where_clause = " AND ".join(filter_clauses) if filter_clauses else "1=1" # Use 1=1 if no filters
+    highlight_expr = "highlight(shapes_fts, 0, '[HL]', '[/HL]')" if with_highlights else "NULL"
+    total_column = ",\n                COUNT(*) OVER () AS total_count" if with_total else ""
+    if mode == 'fts' and filter_clauses:
+        # Rank inside FTS5 first, then filter the bounded candidate set: a MATCH coupled with
+        # predicates on joined tables can make the planner give up the FTS index. The inner
+        # LIMIT is inflated so enough candidates survive the filters.
+        return f"""
+            WITH fts_matches AS (
+                SELECT rowid, rank AS score,
+                       {highlight_expr} AS highlighted_name
+                FROM shapes_fts
+                WHERE shapes_fts MATCH :search_term_fts
+                ORDER BY rank
+                LIMIT :fts_candidate_limit
+            )
+            SELECT
+                s.id AS shape_id,
+                s.name AS shape_name,
+                st.name AS stencil_name,
+                st.path AS stencil_path,
+                s.width AS width,
+                s.height AS height,
+                s.geometry AS geometry,
+                s.properties AS properties,
+                fm.highlighted_name AS highlighted_name{total_column}
+            FROM fts_matches fm
+            JOIN shapes s ON s.id = fm.rowid
+            JOIN stencils st ON s.stencil_path = st.path
+            WHERE {where_clause}
+            ORDER BY fm.score, st.name, s.name
+            LIMIT :limit OFFSET :offset
+        """
+    if mode == 'fts':
+        # highlight() marks the matched spans of the full name from FTS5 token offsets, in C
+        return f"""
+            SELECT
+                s.id AS shape_id,
+                s.name AS shape_name,
+                st.name AS stencil_name,
+                st.path AS stencil_path,
+                s.width AS width,
+                s.height AS height,
+                s.geometry AS geometry,
+                s.properties AS properties,
+                {highlight_expr} AS highlighted_name{total_column}
+            FROM shapes_fts f
+            JOIN shapes s ON f.rowid = s.id
+            JOIN stencils st ON s.stencil_path = st.path
+            WHERE shapes_fts MATCH :search_term_fts
+            ORDER BY rank
+            LIMIT :limit OFFSET :offset
+        """
+    if mode == 'like':
+        # The trigram tokenizer serves LIKE '%term%' on shapes_fts from its index instead of a scan of shapes
+        return f"""
+            SELECT
+                s.id AS shape_id,
+                s.name AS shape_name,
+                st.name AS stencil_name,
+                st.path AS stencil_path,
+                s.width AS width,
+                s.height AS height,
+                s.geometry AS geometry,
+                s.properties AS properties,
+                NULL AS highlighted_name{total_column} -- highlight() needs a MATCH
+            FROM shapes_fts f
+            JOIN shapes s ON s.id = f.rowid
+            JOIN stencils st ON s.stencil_path = st.path
+            WHERE f.name LIKE :search_term_like AND {where_clause}
+            ORDER BY st.name, s.name
+            LIMIT :limit OFFSET :offset
+        """
+    name_clause = "s.name LIKE :search_term_like AND " if mode == 'scan' else ""
+    return f"""
+            SELECT
+                s.id AS shape_id,
+                s.name AS shape_name,
+                st.name AS stencil_name,
+                st.path AS stencil_path,
+                s.width AS width,
+                s.height AS height,
+                s.geometry AS geometry,
+                s.properties AS properties,
+                NULL AS highlighted_name{total_column} -- No highlight for standard search
+            FROM shapes s
+            JOIN stencils st ON s.stencil_path = st.path
+            WHERE {name_clause}{where_clause}
+            ORDER BY st.name, s.name
+            LIMIT :limit OFFSET :offset
+        """
+
 
 class StencilDatabase:
     """SQLite database manager for caching stencil data"""
 
-    def __init__(self, db_path: str = "app/data/stencil_cache.db"): # Adjusted default path relative to project root
-        """Initialize database connection"""
-        project_root_dir = Path(__file__).resolve().parent.parent.parent
-        self.db_path = project_root_dir / Path(db_path)
-        self._conn = None
-        self._lock = threading.Lock() # Lock for thread safety
+    def __init__(self, db_path: str = "app/data/stencil_cache.db", check_integrity: bool = False): # Adjusted default path relative to project root
+        """
+        Initialize database connection.
+        check_integrity forces a full PRAGMA integrity_check at startup; otherwise a quick_check
+        runs only if the last successful check is older than _INTEGRITY_CHECK_INTERVAL.
+        """
+        self.db_path = _PROJECT_ROOT / Path(db_path)
+        self._tls = threading.local() # One connection per thread; WAL lets readers run concurrently
+        self._connections = [] # Every connection opened, so close() can release them all
+        self._connections_lock = threading.Lock()
+        self._lock = threading.RLock() # Serializes writes only; re-entrant for nested write helpers
+        self._stencils_since_analyze = 0 # Write counter driving the periodic ANALYZE
+        self._fav_cache = None # (conn, data_version, stencil paths, shape ids); see _favorite_sets()
+        self._shape_count_cache = None # (conn, data_version, total_changes, count); see _shape_count()
+        self._force_integrity_check = check_integrity
+        self._has_fts: Optional[bool] = None # Cached shapes_fts existence probe; reset by _init_db and rebuild_fts_index
+        self._integrity_stamp_path = self.db_path.parent / f".{self.db_path.name}.last_integrity_check"
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
-        print(f"Database path set to: {self.db_path.resolve()}")
+        logger.debug("Database path set to: %s", self.db_path)
         self._init_db()
 
     def close(self):
-        """Close the database connection safely."""
-        print("DEBUG: db.py - Attempting to acquire lock for close...")
+        """
+        Close all of this instance's database connections safely. Pages open and close short-lived
+        instances per request, so closing does no maintenance; that is post_scan_maintenance()'s job.
+        """
+        logger.debug("Attempting to acquire lock for close...")
         with self._lock:
-            print("DEBUG: db.py - Lock acquired for close.")
-            print("DEBUG: db.py - Before self._conn.close()")
-            if self._conn:
-                try:
-                    self._conn.close()
-                    print("DEBUG: db.py - After self._conn.close()")
-                except Exception as e:
-                    print(f"Error closing database connection: {e}")
-                finally:
-                    self._conn = None
-            print("DEBUG: db.py - Lock released after close.")
+            logger.debug("Lock acquired for close.")
+            self._close_connections()
+            logger.debug("Lock released after close.")
+
+    def post_scan_maintenance(self):
+        """
+        After a bulk scan: let PRAGMA optimize refresh any planner statistics the scan skewed, then
+        fold the WAL back into the main file and truncate it, so later readers don't walk a large WAL.
+        """
+        with self._lock:
+            conn = self._get_conn()
+            try:
+                conn.execute("PRAGMA optimize")
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.Error as e:
+                logger.error("Error running post-scan maintenance: %s", e)
+
+    def _close_connections(self):
+        """Close every pooled connection; threads get a fresh one on their next _get_conn()."""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+            self._tls = threading.local()
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.warning("Error closing database connection: %s", e)
 
     def _get_conn(self) -> sqlite3.Connection:
-        """Get database connection (using check_same_thread=False with external lock)"""
-        if not self._conn:
-            print(f"Connecting to DB: {self.db_path.resolve()}")
+        """Get the calling thread's database connection, opening it on first use."""
+        conn = getattr(self._tls, 'conn', None)
+        if conn is None:
+            logger.debug("Connecting to DB: %s", self.db_path)
             try:
-                self._conn = sqlite3.connect(str(self.db_path.resolve()), check_same_thread=False)
-                self._conn.row_factory = sqlite3.Row
-                self._conn.execute("PRAGMA foreign_keys = ON")
-                print("DB connection successful.")
+                # isolation_level=None: autocommit, transactions are driven with explicit BEGIN/COMMIT
+                conn = sqlite3.connect(str(self.db_path.resolve()), check_same_thread=False,
+                                       isolation_level=None, cached_statements=512)
+                self._configure_connection(conn)
+                logger.debug("DB connection successful.")
             except sqlite3.Error as e:
-                print(f"!!! Database connection error: {e}")
+                logger.error("Database connection error: %s", e)
                 raise
-        return self._conn
+            with self._connections_lock:
+                self._connections.append(conn)
+                self._tls.conn = conn
+        return conn
+
+    @staticmethod
+    def _row_cursor(conn: sqlite3.Connection) -> sqlite3.Cursor:
+        """Cursor yielding sqlite3.Row, for the methods that hand rows out as dicts; other queries use plain tuples."""
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        return cursor
+
+    def _configure_connection(self, conn: sqlite3.Connection):
+        """Apply per-connection PRAGMAs: WAL journaling plus cache/sync tuning."""
+        conn.execute("PRAGMA foreign_keys = ON")
+        if self.db_path.name != ":memory:":
+            journal_mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+            if journal_mode.lower() != "wal":
+                # e.g. network filesystems refuse WAL; keep working in the default mode
+                logger.warning("WAL journal mode not available, using '%s'.", journal_mode)
+        conn.execute("PRAGMA synchronous = NORMAL") # Safe with WAL; fsync only at checkpoints
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -65536") # 64 MiB page cache
+        conn.execute("PRAGMA mmap_size = 268435456") # 256 MiB memory-mapped I/O
+        conn.execute("PRAGMA busy_timeout = 5000")
+        conn.execute("PRAGMA wal_autocheckpoint = 10000") # ~40 MiB of WAL between automatic checkpoints during scans
+        conn.execute("PRAGMA analysis_limit = 1000") # ANALYZE/optimize sample ~1000 rows per index instead of full scans
 
     def _init_db(self):
         """Initialize database schema"""
-        print("DEBUG: db.py - About to acquire lock in _init_db for StencilDatabase")
+        logger.debug("About to acquire lock in _init_db for StencilDatabase")
         with self._lock:
-            print("DEBUG: db.py - Lock acquired in _init_db for StencilDatabase")
+            logger.debug("Lock acquired in _init_db for StencilDatabase")
             conn = self._get_conn()
-            if not self._check_integrity():
-                print("Integrity check failed, attempting recovery/recreation.")
+            if self._integrity_check_due() and not self._check_integrity(full=self._force_integrity_check):
+                logger.warning("Integrity check failed, attempting recovery/recreation.")
                 self._recreate_tables()
                 conn = self._get_conn()
 
-            self._run_migrations(conn) # Apply schema changes if needed
+            # user_version marks a schema that is already current: skip the migration probes on every startup,
+            # and on a brand-new file (no stencils table yet) there is nothing to migrate either
+            migrated = True
+            if conn.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+                if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='stencils'").fetchone():
+                    migrated = self._run_migrations(conn) # Apply schema changes if needed
             self._init_db_schema(conn) # Create tables if they don't exist
-        print("DEBUG: db.py - Lock released in _init_db for StencilDatabase")
+            # Stamped only once the migrations went through, so a failed one runs again on the next start
+            if self.fts_available and migrated: conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+            self._has_fts = None
+            # 0x10002: check every table (not just ones queried on this connection) and seed missing sqlite_stat1 rows
+            try: conn.execute("PRAGMA optimize(0x10002)")
+            except sqlite3.Error as e: logger.warning("Error running PRAGMA optimize: %s", e)
+        logger.debug("Lock released in _init_db for StencilDatabase")
 
     # Helper for schema creation, called by _init_db and _recreate_tables
     def _init_db_schema(self, conn):
@@ -72,13 +371,8 @@ class StencilDatabase:
         Initialize or migrate the database schema, including FTS index.
         Adds retry logic for FTS initialization with detailed logging and graceful fallback.
         """
-        import time
-        import logging
-        import traceback
-
         self.fts_available = True  # Assume FTS is available unless proven otherwise
         max_retries = 3
-        logger = logging.getLogger("db")
 
         for attempt in range(1, max_retries + 1):
             try:
@@ -87,7 +381,7 @@ class StencilDatabase:
                     CREATE TABLE IF NOT EXISTS stencils (
                         path TEXT PRIMARY KEY, name TEXT NOT NULL, extension TEXT NOT NULL,
                         shape_count INTEGER NOT NULL, file_size INTEGER,
-                        last_scan TIMESTAMP NOT NULL, last_modified TIMESTAMP NOT NULL
+                        last_scan TIMESTAMP NOT NULL, last_modified INTEGER NOT NULL -- file mtime, Unix seconds
                     )""")
                 # Shapes Table
                 conn.execute("""
@@ -98,37 +392,59 @@ class StencilDatabase:
                         FOREIGN KEY (stencil_path) REFERENCES stencils(path) ON DELETE CASCADE
                     )""")
                 # FTS Table (may fail if extension unavailable or DB locked)
-                conn.execute("""
-                    CREATE VIRTUAL TABLE IF NOT EXISTS shapes_fts USING fts5(
-                        id, name, stencil_path, content='shapes', content_rowid='id',
-                        tokenize='porter unicode61'
-                    )""")
-                # FTS Triggers
-                conn.execute("""CREATE TRIGGER IF NOT EXISTS shapes_ai AFTER INSERT ON shapes BEGIN
-                                INSERT INTO shapes_fts(rowid, name, stencil_path) VALUES (new.id, new.name, new.stencil_path); END""")
-                conn.execute("""CREATE TRIGGER IF NOT EXISTS shapes_ad AFTER DELETE ON shapes BEGIN
-                                INSERT INTO shapes_fts(shapes_fts, rowid, name, stencil_path) VALUES ('delete', old.id, old.name, old.stencil_path); END""")
-                conn.execute("""CREATE TRIGGER IF NOT EXISTS shapes_au AFTER UPDATE ON shapes BEGIN
-                                INSERT INTO shapes_fts(shapes_fts, rowid, name, stencil_path) VALUES ('delete', old.id, old.name, old.stencil_path);
-                                INSERT INTO shapes_fts(rowid, name, stencil_path) VALUES (new.id, new.name, new.stencil_path); END""")
+                fts_rebuild_needed = self._drop_stale_fts_table(conn)
+                conn.execute(_FTS_TABLE_SQL)
+                # FTS Triggers. Missing ones mean shape writes went unindexed (e.g. a deferred_fts_index()
+                # load that never finished), so the index is rebuilt as well
+                present = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name IN (SELECT value FROM json_each(?))",
+                                       (json.dumps(list(_FTS_TRIGGERS_SQL)),)).fetchone()[0]
+                fts_rebuild_needed = fts_rebuild_needed or present < len(_FTS_TRIGGERS_SQL)
+                for trigger_sql in _FTS_TRIGGERS_SQL.values():
+                    conn.execute(trigger_sql)
+                self._configure_fts_rank(conn)
+                if fts_rebuild_needed:
+                    conn.execute("INSERT INTO shapes_fts(shapes_fts) VALUES('rebuild')")
+                    logger.info("FTS index rebuilt (definition changed or triggers were missing).")
                 # Indexes
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_stencils_path ON stencils(path)")
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_shapes_stencil_path ON shapes(stencil_path)")
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_shapes_name ON shapes(name)")
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_shapes_name_stencil_path ON shapes(name, stencil_path)")
+                # (stencil_path, name) identifies a shape across rescans, so cache_stencil can upsert in place;
+                # it also serves every stencil_path lookup the old single-column index did
+                if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_shapes_path_name'").fetchone():
+                    conn.execute("DELETE FROM shapes WHERE id NOT IN (SELECT MIN(id) FROM shapes GROUP BY stencil_path, name)")
+                    conn.execute("CREATE UNIQUE INDEX idx_shapes_path_name ON shapes(stencil_path, name)")
+                conn.execute("DROP INDEX IF EXISTS idx_shapes_stencil_path")
+                # Covering index for the per-stencil shape listings (get_stencil_by_path and friends): id rides
+                # along as the rowid, so they are answered from the index without visiting shapes rows
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_shapes_stencil_cover ON shapes(stencil_path, name, width, height)")
                 conn.execute("CREATE INDEX IF NOT EXISTS idx_stencils_last_modified ON stencils(last_modified)")
                 conn.execute("CREATE INDEX IF NOT EXISTS idx_stencils_file_size ON stencils(file_size)")
                 conn.execute("CREATE INDEX IF NOT EXISTS idx_stencils_shape_count ON stencils(shape_count)")
+                # Covering index for search_shapes: the join on path plus every filtered/returned stencil column,
+                # so filtering FTS candidates never touches the stencils table itself
+                cover_index_missing = not conn.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_stencils_cover'").fetchone()
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_stencils_cover ON stencils(path, last_modified, file_size, shape_count, name)")
+                if cover_index_missing: conn.execute("ANALYZE stencils") # Give the planner stats for the new index
                 # Preset Directories Table
                 conn.execute("""CREATE TABLE IF NOT EXISTS preset_directories (
                                 id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT UNIQUE NOT NULL, name TEXT NOT NULL,
                                 is_active BOOLEAN DEFAULT 0, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP )""")
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_preset_directories_path ON preset_directories(path)")
                 # Saved Searches Table
                 conn.execute("""CREATE TABLE IF NOT EXISTS saved_searches (
                                 id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, search_term TEXT,
                                 filters TEXT NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP )""")
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_saved_searches_name ON saved_searches(name)")
+                # Saved search filters, one typed row per key: numbers and strings are stored natively so
+                # reading them back needs no JSON parsing; only lists/dicts/booleans keep a JSON encoding.
+                conn.execute("""CREATE TABLE IF NOT EXISTS saved_search_filters (
+                                search_id INTEGER NOT NULL, key TEXT NOT NULL, value, is_json BOOLEAN NOT NULL DEFAULT 0,
+                                PRIMARY KEY (search_id, key),
+                                FOREIGN KEY (search_id) REFERENCES saved_searches(id) ON DELETE CASCADE )""")
+                # Backfill searches saved before the typed table existed (JSON1 splits the blob in SQL)
+                conn.execute("""INSERT OR IGNORE INTO saved_search_filters (search_id, key, value, is_json)
+                                SELECT s.id, j.key, CASE WHEN j.type IN ('integer', 'real', 'text', 'null') THEN j.value
+                                            WHEN j.type IN ('true', 'false') THEN j.type ELSE json_quote(j.value) END,
+                                       j.type NOT IN ('integer', 'real', 'text', 'null')
+                                FROM saved_searches s, json_each(s.filters) j
+                                WHERE json_valid(s.filters) AND json_type(s.filters) = 'object'
+                                  AND NOT EXISTS (SELECT 1 FROM saved_search_filters f WHERE f.search_id = s.id)""")
                 # Favorites Table
                 conn.execute("""
                     CREATE TABLE IF NOT EXISTS favorites (
@@ -141,355 +457,589 @@ class StencilDatabase:
                         FOREIGN KEY (shape_id) REFERENCES shapes(id) ON DELETE CASCADE
                     )
                 """)
+                # Create partial unique indexes separately
+                conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_fav_stencil_unique ON favorites(stencil_path) WHERE item_type = 'stencil'")
+                conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_fav_shape_unique ON favorites(shape_id) WHERE item_type = 'shape' AND shape_id IS NOT NULL") # Added shape_id IS NOT NULL check
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_favorites_stencil_path ON favorites(stencil_path)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_favorites_shape_id ON favorites(shape_id) WHERE shape_id IS NOT NULL")
+
+                # Collections Table
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS collections (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT UNIQUE NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        shape_count INTEGER NOT NULL DEFAULT 0
+                    )""")
+
+                # Collection Shapes Mapping Table
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS collection_shapes (
+                        collection_id INTEGER NOT NULL,
+                        shape_id INTEGER NOT NULL,
+                        added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (collection_id) REFERENCES collections(id) ON DELETE CASCADE,
+                        FOREIGN KEY (shape_id) REFERENCES shapes(id) ON DELETE CASCADE,
+                        PRIMARY KEY (collection_id, shape_id)
+                    )""")
+                # (collection_id, added_at) serves get_collection_details' filter and ORDER BY without a sort;
+                # it also covers every lookup the old collection_id-only index served
+                new_sort_indexes = not conn.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_cs_coll_added'").fetchone()
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_cs_coll_added ON collection_shapes(collection_id, added_at DESC)")
+                conn.execute("DROP INDEX IF EXISTS idx_collection_shapes_coll_id")
+                # get_favorites lists all favorites newest first
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_favorites_added_at ON favorites(added_at DESC)")
+                if new_sort_indexes:
+                    conn.execute("ANALYZE collection_shapes")
+                    conn.execute("ANALYZE favorites")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_collection_shapes_shape_id ON collection_shapes(shape_id)")
+                for trigger_sql in _COLLECTION_TRIGGERS_SQL.values():
+                    conn.execute(trigger_sql)
+
                 # Success, break out of retry loop
                 break
             except Exception as e:
-                logger.error(f"Attempt {attempt}: Error initializing FTS index or tables: {e}")
-                traceback.print_exc()
+                logger.exception("Attempt %s: Error initializing FTS index or tables: %s", attempt, e)
                 time.sleep(0.5)
                 if attempt == max_retries:
                     self.fts_available = False
                     logger.error("FTS index initialization failed after multiple attempts. Full traceback above. Falling back to standard search.")
-            # Create partial unique indexes separately
-            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_fav_stencil_unique ON favorites(stencil_path) WHERE item_type = 'stencil'")
-            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_fav_shape_unique ON favorites(shape_id) WHERE item_type = 'shape' AND shape_id IS NOT NULL") # Added shape_id IS NOT NULL check
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_favorites_stencil_path ON favorites(stencil_path)")
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_favorites_shape_id ON favorites(shape_id) WHERE shape_id IS NOT NULL")
-
-            # Collections Table
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS collections (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT UNIQUE NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )""")
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_collections_name ON collections(name)")
-
-            # Collection Shapes Mapping Table
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS collection_shapes (
-                    collection_id INTEGER NOT NULL,
-                    shape_id INTEGER NOT NULL,
-                    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (collection_id) REFERENCES collections(id) ON DELETE CASCADE,
-                    FOREIGN KEY (shape_id) REFERENCES shapes(id) ON DELETE CASCADE,
-                    PRIMARY KEY (collection_id, shape_id)
-                )""")
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_collection_shapes_coll_id ON collection_shapes(collection_id)")
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_collection_shapes_shape_id ON collection_shapes(shape_id)")
-
-            conn.commit()
-
-
-    def _check_integrity(self):
-        """Check database integrity"""
+
+
+    def _configure_fts_rank(self, conn):
+        """Persist the bm25 column weights used by ORDER BY rank (stored in shapes_fts_config)."""
+        current = conn.execute("SELECT v FROM shapes_fts_config WHERE k = 'rank'").fetchone()
+        if current is None or current[0] != _FTS_RANK:
+            conn.execute("INSERT INTO shapes_fts(shapes_fts, rank) VALUES('rank', ?)", (_FTS_RANK,))
+
+    def _drop_stale_fts_table(self, conn) -> bool:
+        """Drop shapes_fts (and its triggers) if it was created with an older definition. Returns True if dropped."""
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='shapes_fts'").fetchone()
+        if not row or " ".join(row[0].split()) == " ".join(_FTS_TABLE_SQL.replace("IF NOT EXISTS ", "").split()):
+            return False
+        logger.info("FTS table definition changed (e.g. tokenizer); recreating shapes_fts...")
+        for trigger in ('shapes_ai', 'shapes_ad', 'shapes_au'):
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        conn.execute("DROP TABLE shapes_fts")
+        return True
+
+    def _integrity_check_due(self) -> bool:
+        """Whether startup should verify the database: when forced, or when the last check is stale."""
+        if self._force_integrity_check: return True
+        try: return time.time() - self._integrity_stamp_path.stat().st_mtime > _INTEGRITY_CHECK_INTERVAL
+        except OSError: return True
+
+    def _check_integrity(self, full: bool = False):
+        """
+        Check database integrity. quick_check skips the index-vs-table cross checks that make
+        integrity_check slow on large caches; full=True runs the complete check.
+        """
         conn = self._get_conn()
         try:
-            integrity_check = conn.execute("PRAGMA integrity_check").fetchone()[0]
+            # (10) caps the error rows SQLite collects; a healthy database yields the single row 'ok'
+            cursor = conn.execute("PRAGMA integrity_check(10)" if full else "PRAGMA quick_check(10)")
+            integrity_check = cursor.fetchone()[0]
             if integrity_check == "ok":
-                print("Database integrity check passed.")
+                logger.info("Database integrity check passed.")
+                self._integrity_stamp_path.touch()
                 return True
             else:
-                print(f"!!! Database integrity check failed: {integrity_check}")
-                if self._recover_database(): return self._check_integrity()
+                problems = [integrity_check] + [row[0] for row in cursor]
+                logger.error("Database integrity check failed: %s", '; '.join(problems))
+                if self._recover_database(): return self._check_integrity(full)
                 return False
         except Exception as e:
-            print(f"Error checking database integrity: {e}")
+            logger.error("Error checking database integrity: %s", e)
             return False
 
-    def _run_migrations(self, conn):
-        """Run database migrations to ensure schema is up to date"""
+    def _run_migrations(self, conn) -> bool:
+        """
+        Run database migrations to ensure schema is up to date, all in one transaction.
+        Returns False (with nothing applied) if any step fails, so the schema version is not stamped and it is retried.
+        """
         try:
-            # Check and migrate 'shapes' table
-            shapes_cursor = conn.execute("PRAGMA table_info(shapes)")
-            shapes_columns = {row['name'] for row in shapes_cursor.fetchall()} # Use set for faster lookup
-            if 'width' not in shapes_columns: conn.execute("ALTER TABLE shapes ADD COLUMN width REAL DEFAULT 0")
-            if 'height' not in shapes_columns: conn.execute("ALTER TABLE shapes ADD COLUMN height REAL DEFAULT 0")
-            if 'geometry' not in shapes_columns: conn.execute("ALTER TABLE shapes ADD COLUMN geometry TEXT")
-            if 'properties' not in shapes_columns: conn.execute("ALTER TABLE shapes ADD COLUMN properties TEXT")
-
-            # Check and migrate 'stencils' table
-            stencils_cursor = conn.execute("PRAGMA table_info(stencils)")
-            stencils_columns = {row['name'] for row in stencils_cursor.fetchall()}
-            if 'file_size' not in stencils_columns:
-                print("Adding 'file_size' column to 'stencils' table...")
-                conn.execute("ALTER TABLE stencils ADD COLUMN file_size INTEGER")
-                # Optionally, backfill file_size if possible/needed, though caching will handle it
-                print("'file_size' column added.")
-
-            conn.commit()
-            print("Database migrations checked/completed.")
+            with self._transaction(conn):
+                # Indexes that duplicated the stencils PRIMARY KEY / preset_directories, saved_searches and collections
+                # UNIQUE autoindexes, and shapes(name) / shapes(name, stencil_path), which no query looks shapes up by
+                conn.execute("DROP INDEX IF EXISTS idx_stencils_path")
+                conn.execute("DROP INDEX IF EXISTS idx_preset_directories_path")
+                conn.execute("DROP INDEX IF EXISTS idx_saved_searches_name")
+                conn.execute("DROP INDEX IF EXISTS idx_collections_name")
+                conn.execute("DROP INDEX IF EXISTS idx_shapes_name")
+                conn.execute("DROP INDEX IF EXISTS idx_shapes_name_stencil_path")
+
+                # Check and migrate 'shapes' table
+                shapes_cursor = conn.execute("PRAGMA table_info(shapes)")
+                shapes_columns = {row[1] for row in shapes_cursor.fetchall()} # Use set for faster lookup
+                if 'width' not in shapes_columns: conn.execute("ALTER TABLE shapes ADD COLUMN width REAL DEFAULT 0")
+                if 'height' not in shapes_columns: conn.execute("ALTER TABLE shapes ADD COLUMN height REAL DEFAULT 0")
+                if 'geometry' not in shapes_columns: conn.execute("ALTER TABLE shapes ADD COLUMN geometry TEXT")
+                if 'properties' not in shapes_columns: conn.execute("ALTER TABLE shapes ADD COLUMN properties TEXT")
+
+                # Check and migrate 'stencils' table
+                stencils_cursor = conn.execute("PRAGMA table_info(stencils)")
+                stencils_columns = {row[1] for row in stencils_cursor.fetchall()}
+                if 'file_size' not in stencils_columns:
+                    logger.info("Adding 'file_size' column to 'stencils' table...")
+                    conn.execute("ALTER TABLE stencils ADD COLUMN file_size INTEGER")
+                    # Optionally, backfill file_size if possible/needed, though caching will handle it
+                    logger.info("'file_size' column added.")
+                # last_modified used to hold local-time ISO strings; 'utc' reads them as local time. Unparseable values
+                # become 0, which just makes the next scan re-cache that stencil
+                conn.execute("""UPDATE stencils SET last_modified = COALESCE(CAST(strftime('%s', last_modified, 'utc') AS INTEGER), 0)
+                                WHERE typeof(last_modified) = 'text'""")
+
+                # Denormalized membership count for get_collections, backfilled once from collection_shapes
+                collections_columns = {row[1] for row in conn.execute("PRAGMA table_info(collections)")}
+                if collections_columns and 'shape_count' not in collections_columns:
+                    conn.execute("ALTER TABLE collections ADD COLUMN shape_count INTEGER NOT NULL DEFAULT 0")
+                    conn.execute("UPDATE collections SET shape_count = (SELECT COUNT(*) FROM collection_shapes WHERE collection_id = collections.id)")
+
+            logger.debug("Database migrations checked/completed.")
+            return True
         except Exception as e:
-            print(f"Error running migrations: {str(e)}")
-            conn.rollback() # Rollback changes if a migration fails
+            logger.error("Error running migrations (rolled back, retried on next start): %s", e)
+            return False
 
     def _recreate_tables(self):
         """Recreate database tables (use when integrity check fails)"""
-        print("Attempting to recreate database tables...")
+        logger.warning("Attempting to recreate database tables...")
         try:
-            if self._conn:
-                self._conn.close()
-                self._conn = None
-            backup_path = f"{self.db_path}.backup.{datetime.now().strftime('%Y%m%d%H%M%S')}"
+            self._close_connections()
+            backup_path = f"{self.db_path}.backup.{time.time_ns()}"
             if self.db_path.exists():
-                import shutil
-                shutil.copy2(str(self.db_path), backup_path)
-                print(f"Created database backup at {backup_path}")
+                self._backup_database_file(backup_path)
+                logger.info("Created database backup at %s", backup_path)
                 self.db_path.unlink() # Use unlink from Path object
-                print(f"Removed corrupted database at {self.db_path}")
+                logger.info("Removed corrupted database at %s", self.db_path)
             # Remove WAL/SHM files
-            for suffix in ['-wal', '-shm']:
-                 wal_path = self.db_path.with_suffix(f"{self.db_path.suffix}{suffix}")
-                 if wal_path.exists(): wal_path.unlink(); print(f"Removed {wal_path}")
+            for suffix in ('-wal', '-shm'): self.db_path.with_suffix(self.db_path.suffix + suffix).unlink(missing_ok=True)
             # Re-initialize connection and schema
-            self._conn = None
             conn = self._get_conn() # Establishes new connection
             # Rerun schema creation logic directly
             self._init_db_schema(conn)
-            print("Database tables recreated. Please rescan stencils.")
+            logger.warning("Database tables recreated. Please rescan stencils.")
             return True
         except Exception as e:
-            print(f"Error recreating database tables: {e}")
-            traceback.print_exc()
+            logger.exception("Error recreating database tables: %s", e)
             return False
 
+    def _backup_database_file(self, backup_path: str):
+        """
+        Copy the database with SQLite's online backup API, which reads committed pages (WAL included)
+        under SQLite's own locking. Falls back to a raw file copy when the pages are too damaged to read.
+        """
+        try:
+            src = sqlite3.connect(str(self.db_path))
+            try:
+                dst = sqlite3.connect(backup_path)
+                try: src.backup(dst)
+                finally: dst.close()
+            finally: src.close()
+        except sqlite3.DatabaseError as e:
+            logger.warning("Online backup failed (%s); copying the raw database file instead.", e)
+            shutil.copy2(str(self.db_path), backup_path)
+
+    def _build_stencil_rows(self, stencil_data: Dict[str, Any], scan_time_iso: str):
+        """Stat the stencil file and build its stencils-row and shapes-rows tuples (no DB access)."""
+        file_stat = Path(stencil_data['path']).stat()
+        stencil_row = (stencil_data['path'], stencil_data['name'], stencil_data['extension'],
+                       stencil_data['shape_count'], file_stat.st_size, scan_time_iso, int(file_stat.st_mtime))
+        path = stencil_data['path']
+        shape_rows = []
+        for shape in stencil_data['shapes'] or []:
+            # Handle both old format (string) and new format (dict)
+            if isinstance(shape, str):
+                shape_rows.append((path, shape, 0, 0, None, None))
+            else:
+                # Empty geometry/properties are stored as NULL without a json.dumps call
+                geometry, properties = shape.get('geometry'), shape.get('properties')
+                shape_rows.append((path, shape['name'], shape.get('width', 0), shape.get('height', 0),
+                                   json.dumps(geometry) if geometry else None,
+                                   json.dumps(properties) if properties else None))
+        return stencil_row, shape_rows
+
+    @staticmethod
+    def _shape_names_param(path: str, shape_rows: List[tuple]) -> tuple:
+        """(stencil path, JSON array of its shape names) for _SQL_DELETE_REMOVED_SHAPES."""
+        return path, json.dumps([row[1] for row in shape_rows])
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _transaction(conn: sqlite3.Connection):
+        """
+        Write transaction on an autocommit connection: BEGIN IMMEDIATE takes the write lock up front
+        (no deferred-to-write upgrade that can fail with SQLITE_BUSY mid-way), COMMIT on success,
+        ROLLBACK if the block or the COMMIT raises.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction: conn.execute("ROLLBACK")
+            raise
+
     def cache_stencil(self, stencil_data: Dict[str, Any]):
         """Cache a single stencil's data, including its shapes"""
         with self._lock:
+            self._fav_cache = None # Shapes removed from a stencil cascade to their favorites
             conn = self._get_conn()
-            cursor = conn.cursor()
             try:
-                file_path = Path(stencil_data['path'])
-                file_stat = file_path.stat()
-                last_modified_iso = datetime.fromtimestamp(file_stat.st_mtime).isoformat()
-                file_size = file_stat.st_size
-
-                # Start a transaction for atomicity
-                conn.execute("BEGIN TRANSACTION")
-
-                # Insert or replace stencil metadata
-                cursor.execute("""
-                    INSERT OR REPLACE INTO stencils
-                    (path, name, extension, shape_count, file_size, last_scan, last_modified)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    stencil_data['path'], stencil_data['name'], stencil_data['extension'],
-                    stencil_data['shape_count'], file_size, datetime.now().isoformat(), last_modified_iso
-                ))
-
-                # Delete existing shapes for this stencil before inserting new ones
-                cursor.execute("DELETE FROM shapes WHERE stencil_path = ?", (stencil_data['path'],))
-
-                # Insert shapes if any
-                shape_ids = []
-                if stencil_data['shapes']:
-                    for shape in stencil_data['shapes']:
-                        # Handle both old format (string) and new format (dict)
-                        if isinstance(shape, str):
-                            shape_name, width, height, geometry, properties = shape, 0, 0, None, None
-                        else:
-                            shape_name = shape['name']
-                            width = shape.get('width', 0)
-                            height = shape.get('height', 0)
-                            geometry = json.dumps(shape.get('geometry', [])) if shape.get('geometry') else None
-                            properties = json.dumps(shape.get('properties', {})) if shape.get('properties') else None
-
-                        cursor.execute("""
-                            INSERT INTO shapes (stencil_path, name, width, height, geometry, properties)
-                            VALUES (?, ?, ?, ?, ?, ?)
-                        """, (stencil_data['path'], shape_name, width, height, geometry, properties))
-                        shape_ids.append(cursor.lastrowid)
-
-                # Commit transaction
-                conn.execute("COMMIT")
-
-                # Verify FTS index is in sync (Optional Safety Check)
-                try:
-                    fts_rows = conn.execute("SELECT COUNT(*) FROM shapes_fts WHERE stencil_path = ?", (stencil_data['path'],)).fetchone()[0]
-                    actual_rows = len(stencil_data['shapes']) if stencil_data['shapes'] else 0
-                    if fts_rows != actual_rows:
-                        print(f"FTS index mismatch for {stencil_data['name']}. Rebuilding subset...")
-                        conn.execute("DELETE FROM shapes_fts WHERE stencil_path = ?", (stencil_data['path'],))
-                        if shape_ids: # Only reinsert if shapes were actually added
-                            # Fetch name for each shape_id before inserting into FTS
-                            reinsert_data = []
-                            for sid in shape_ids:
-                                name_row = conn.execute("SELECT name FROM shapes WHERE id=?", (sid,)).fetchone()
-                                if name_row:
-                                    reinsert_data.append((sid, name_row['name'], stencil_data['path']))
-                            if reinsert_data:
-                                conn.executemany("INSERT INTO shapes_fts(rowid, name, stencil_path) VALUES (?, ?, ?)", reinsert_data)
-                        conn.commit() # Commit FTS rebuild subset
-                except Exception as fts_e:
-                    print(f"Error verifying/rebuilding FTS subset for {stencil_data.get('path')}: {fts_e}")
-                    # Don't let FTS verification fail the main caching operation
+                stencil_row, shape_rows = self._build_stencil_rows(stencil_data, datetime.now().isoformat())
+                with self._transaction(conn):
+                    # Insert or update stencil metadata
+                    conn.execute(_SQL_UPSERT_STENCIL, stencil_row)
+                    # Drop shapes that left the stencil, then insert new ones and update changed ones in place
+                    conn.execute(_SQL_DELETE_REMOVED_SHAPES, self._shape_names_param(stencil_row[0], shape_rows))
+                    if shape_rows:
+                        conn.executemany(_SQL_UPSERT_SHAPE, shape_rows)
+                self._count_stencil_writes(conn, 1)
+            except Exception as e:
+                logger.exception("Error caching stencil %s: %s", stencil_data.get('path', 'N/A'), e)
+                raise
+
+    def _count_stencil_writes(self, conn: sqlite3.Connection, count: int):
+        """Track cached stencils and refresh planner statistics once enough have changed to skew the query plans."""
+        self._stencils_since_analyze += count
+        if self._stencils_since_analyze >= _ANALYZE_EVERY_STENCILS:
+            self._stencils_since_analyze = 0
+            try: conn.execute("ANALYZE") # Bounded by analysis_limit, so cheap even on large caches
+            except sqlite3.Error as e: logger.warning("Error running ANALYZE: %s", e)
 
+    def cache_stencils_bulk(self, stencils: List[Dict[str, Any]], rebuild_fts: bool = False) -> int:
+        """
+        Cache many stencils (and their shapes) in a single transaction.
+        Files are stat'ed before the write lock is taken so the critical section is pure SQL.
+        Stencils whose file can no longer be read are skipped. Returns the number cached.
+        rebuild_fts: for mass rescans, drop the FTS triggers for the load and rebuild the index in
+        one pass at the end, instead of one FTS insert/delete per shape.
+        """
+        scan_time_iso = datetime.now().isoformat()
+        stencil_rows, shape_rows, delete_params = [], [], []
+        for stencil_data in stencils:
+            try:
+                stencil_row, rows = self._build_stencil_rows(stencil_data, scan_time_iso)
+            except OSError as e:
+                logger.warning("Skipping stencil %s: %s", stencil_data.get('path', 'N/A'), e)
+                continue
+            stencil_rows.append(stencil_row)
+            shape_rows.extend(rows)
+            delete_params.append(self._shape_names_param(stencil_row[0], rows))
+        if not stencil_rows: return 0
+
+        with self._lock:
+            self._fav_cache = None # Shapes removed from a stencil cascade to their favorites
+            conn = self._get_conn()
+            try:
+                with self._transaction(conn):
+                    if rebuild_fts:
+                        for trigger_name in _FTS_TRIGGERS_SQL: conn.execute(f"DROP TRIGGER IF EXISTS {trigger_name}")
+                    conn.executemany(_SQL_UPSERT_STENCIL, stencil_rows)
+                    conn.executemany(_SQL_DELETE_REMOVED_SHAPES, delete_params)
+                    if shape_rows:
+                        conn.executemany(_SQL_UPSERT_SHAPE, shape_rows)
+                    if rebuild_fts:
+                        # Same transaction: on failure the ROLLBACK restores the triggers and the old index
+                        conn.execute("INSERT INTO shapes_fts(shapes_fts) VALUES('rebuild')")
+                        for trigger_sql in _FTS_TRIGGERS_SQL.values(): conn.execute(trigger_sql)
+                logger.info("Bulk cached %s stencils (%s shapes).", len(stencil_rows), len(shape_rows))
+                self._count_stencil_writes(conn, len(stencil_rows))
+                return len(stencil_rows)
             except Exception as e:
-                # Rollback transaction on error
-                conn.execute("ROLLBACK")
-                print(f"Error caching stencil {stencil_data.get('path', 'N/A')}: {e}")
-                traceback.print_exc() # Print full traceback
+                logger.exception("Error bulk caching %s stencils: %s", len(stencil_rows), e)
                 raise
 
-    def get_cached_stencils(self) -> List[Dict[str, Any]]:
-        """Retrieve all cached stencils basic info"""
-        stencils_summary = []
+    @contextlib.contextmanager
+    def deferred_fts_index(self):
+        """
+        For a mass load split over several cache_stencils_bulk() calls: the FTS triggers are dropped for
+        the whole block and the index is rebuilt once on exit, like rebuild_fts=True does for a single call.
+        If the process dies inside the block, the next startup finds the triggers missing and rebuilds.
+        """
         with self._lock:
             conn = self._get_conn()
-            stencil_cursor = conn.execute("SELECT path, name, extension, shape_count, file_size, last_modified FROM stencils ORDER BY name")
-            stencils_summary = [dict(row) for row in stencil_cursor.fetchall()]
-        return stencils_summary
+            with self._transaction(conn):
+                for trigger_name in _FTS_TRIGGERS_SQL: conn.execute(f"DROP TRIGGER IF EXISTS {trigger_name}")
+        try:
+            yield
+        finally:
+            with self._lock:
+                conn = self._get_conn()
+                with self._transaction(conn):
+                    conn.execute("INSERT INTO shapes_fts(shapes_fts) VALUES('rebuild')")
+                    for trigger_sql in _FTS_TRIGGERS_SQL.values(): conn.execute(trigger_sql)
+
+    def get_cached_stencils(self) -> List[Dict[str, Any]]:
+        """Retrieve all cached stencils basic info"""
+        return list(self.get_cached_stencils_iter())
+
+    def get_cached_stencils_iter(self, limit: Optional[int] = None, offset: int = 0) -> Iterator[Dict[str, Any]]:
+        """Yield cached stencils' basic info (ordered by name) one at a time; limit/offset are applied in SQL."""
+        conn = self._get_conn()
+        cursor = conn.execute(f"SELECT path, name, extension, shape_count, file_size, {_SQL_LAST_MODIFIED_ISO} FROM stencils ORDER BY name LIMIT ? OFFSET ?",
+                              (-1 if limit is None else limit, offset))
+        cols = [d[0] for d in cursor.description]
+        for row in cursor:
+            yield dict(zip(cols, row))
+
+    def count_cached_stencils(self) -> int:
+        """Number of cached stencils, counted in SQL."""
+        return self._get_conn().execute("SELECT COUNT(*) FROM stencils").fetchone()[0]
+
+    def get_cached_stencils_with_shapes(self) -> List[Dict[str, Any]]:
+        """Retrieve all cached stencils with their shapes (same layout as get_stencil_by_path), ordered by path."""
+        stencils, cursor = [], None
+        while True:
+            page, cursor = self.get_cached_stencils_page(after_path=cursor)
+            stencils.extend(page)
+            if cursor is None: return stencils
+
+    def get_cached_stencils_page(self, after_path: Optional[str] = None, limit: int = 200):
+        """
+        Keyset-paginated stencils (with shapes), ordered by path.
+        Pass the returned cursor as after_path to fetch the next page; it is None after the last page.
+        Uses the path primary key for the seek, so cost doesn't grow with how deep the page is.
+        """
+        conn = self._get_conn()
+        cursor = conn.execute(f"""
+            SELECT st.path, st.name, st.extension, st.shape_count, st.file_size, st.last_scan, st.last_modified,
+                   sh.id, sh.name, sh.width, sh.height
+            FROM (SELECT path, name, extension, shape_count, file_size, last_scan, {_SQL_LAST_MODIFIED_ISO}
+                  FROM stencils WHERE path > ? ORDER BY path LIMIT ?) st
+            LEFT JOIN shapes sh ON sh.stencil_path = st.path
+            ORDER BY st.path, sh.id""", (after_path or "", limit))
+        page = self._group_stencil_rows(cursor)
+        next_cursor = page[-1]['path'] if len(page) == limit else None
+        return page, next_cursor
+
+    @staticmethod
+    def _group_stencil_rows(rows) -> List[Dict[str, Any]]:
+        """Fold (stencil columns..., shape id, name, width, height) join rows into one dict per stencil."""
+        stencils = []
+        for _, group in itertools.groupby(rows, key=lambda row: row[0]):
+            group = list(group)
+            path, name, extension, shape_count, file_size, last_scan, last_modified = tuple(group[0])[:7]
+            stencils.append({
+                'path': path, 'name': name, 'extension': extension, 'shape_count': shape_count,
+                'file_size': file_size, 'last_scan': last_scan, 'last_modified': last_modified,
+                'shapes': [{'shape_id': row[7], 'name': row[8], 'width': row[9], 'height': row[10]}
+                           for row in group if row[7] is not None],
+            })
+        return stencils
 
     def get_stencil_by_path(self, path: str) -> Optional[Dict[str, Any]]:
         """Get a specific stencil by path, including simplified shape info"""
-        with self._lock:
-            conn = self._get_conn()
-            stencil_cursor = conn.execute("SELECT path, name, extension, shape_count, file_size, last_scan, last_modified FROM stencils WHERE path = ?", (path,))
-            stencil_row = stencil_cursor.fetchone()
-            if not stencil_row: return None
-            shape_cursor = conn.execute("SELECT id as shape_id, name, width, height FROM shapes WHERE stencil_path = ?", (path,)) # Added shape_id
-            shapes = [dict(row) for row in shape_cursor.fetchall()]
-            stencil_data = dict(stencil_row)
-            stencil_data['shapes'] = shapes
-            return stencil_data
+        conn = self._get_conn()
+        stencil_cursor = self._row_cursor(conn).execute(_SQL_GET_STENCIL, (path,))
+        stencil_row = stencil_cursor.fetchone()
+        if not stencil_row: return None
+        shape_cursor = self._row_cursor(conn).execute(_SQL_GET_STENCIL_SHAPES, (path,))
+        shapes = [dict(row) for row in shape_cursor.fetchall()]
+        stencil_data = dict(stencil_row)
+        stencil_data['shapes'] = shapes
+        return stencil_data
+
+    @staticmethod
+    def _mtime(path: str) -> int:
+        """File mtime in whole Unix seconds, as stored in stencils.last_modified."""
+        return int(os.stat(path).st_mtime)
 
     def needs_update(self, path: str) -> bool:
-        """Check if a stencil file needs to be re-cached"""
-        file_path = Path(path)
-        if not file_path.exists(): return True
-        try: file_mtime = datetime.fromtimestamp(file_path.stat().st_mtime)
-        except FileNotFoundError: return True
-        with self._lock:
-            conn = self._get_conn()
-            cursor = conn.execute("SELECT last_modified FROM stencils WHERE path = ?", (path,))
-            result = cursor.fetchone()
-            if not result: return True
+        """Check if a stencil file needs to be re-cached (an integer comparison in SQLite)"""
+        try: file_mtime = self._mtime(path)
+        except OSError: return True
+        conn = self._get_conn()
+        return conn.execute(_SQL_IS_FRESH, (path, file_mtime)).fetchone() is None
+
+    def get_all_mtimes(self) -> Dict[str, int]:
+        """Map every cached stencil path to its stored last_modified (Unix seconds), in one query."""
+        conn = self._get_conn()
+        return {path: last_modified for path, last_modified in conn.execute(_SQL_ALL_MTIMES)}
+
+    def needs_update_bulk(self, paths: List[str]) -> Set[str]:
+        """
+        Return the subset of paths that need re-caching: one query for all paths, then os.stat only.
+        The paths go in as one JSON array, so only their rows are probed by primary key and the
+        statement stays the same whatever the number of paths.
+        """
+        paths = list(paths)
+        conn = self._get_conn()
+        cached_mtimes = dict(conn.execute(_SQL_MTIMES_FOR_PATHS, (json.dumps(paths),)))
+        stale = set()
+        for path in paths:
+            cached = cached_mtimes.get(path)
             try:
-                cached_mtime = datetime.fromisoformat(result['last_modified'])
-                return file_mtime > (cached_mtime + timedelta(seconds=1))
-            except (TypeError, ValueError): return True
+                if cached is None or cached < self._mtime(path):
+                    stale.add(path)
+            except (OSError, TypeError):
+                stale.add(path)
+        return stale
 
     # --- Saved Search Methods ---
+    @staticmethod
+    def _saved_search_filter_rows(search_id: int, filters: Dict[str, Any]):
+        """Rows for saved_search_filters: scalars as native SQLite values, everything else JSON-encoded."""
+        rows = []
+        for key, value in (filters or {}).items():
+            if value is None or (isinstance(value, (int, float, str)) and not isinstance(value, bool)):
+                rows.append((search_id, key, value, 0))
+            else:
+                rows.append((search_id, key, json.dumps(value), 1))
+        return rows
+
     def add_saved_search(self, name: str, search_term: str, filters: Dict[str, Any]):
         with self._lock:
             conn = self._get_conn()
             filters_json = json.dumps(filters)
             try:
-                conn.execute("INSERT INTO saved_searches (name, search_term, filters) VALUES (?, ?, ?)", (name, search_term, filters_json))
-                conn.commit()
-            except sqlite3.IntegrityError: print(f"Saved search with name '{name}' already exists.")
-            except Exception as e: print(f"Error saving search '{name}': {e}"); conn.rollback()
+                with self._transaction(conn):
+                    inserted = conn.execute("INSERT INTO saved_searches (name, search_term, filters) VALUES (?, ?, ?) ON CONFLICT(name) DO NOTHING RETURNING id",
+                                            (name, search_term, filters_json)).fetchone()
+                    if inserted:
+                        conn.executemany("INSERT INTO saved_search_filters (search_id, key, value, is_json) VALUES (?, ?, ?, ?)",
+                                         self._saved_search_filter_rows(inserted[0], filters))
+                if not inserted: logger.info("Saved search with name '%s' already exists.", name)
+            except Exception as e:
+                logger.error("Error saving search '%s': %s", name, e)
 
     def get_saved_searches(self) -> List[Dict[str, Any]]:
-        with self._lock:
-            conn = self._get_conn()
-            cursor = conn.execute("SELECT id, name, search_term, filters, created_at FROM saved_searches ORDER BY name")
-            searches = []
-            for row in cursor.fetchall():
-                 search = dict(row)
-                 try: search['filters'] = json.loads(search['filters'])
-                 except (json.JSONDecodeError, TypeError): search['filters'] = {}
-                 searches.append(search)
-            return searches
+        conn = self._get_conn()
+        cursor = conn.execute("""
+            SELECT s.id, s.name, s.search_term, s.created_at, f.key, f.value, f.is_json
+            FROM saved_searches s LEFT JOIN saved_search_filters f ON f.search_id = s.id
+            ORDER BY s.name, s.id""")
+        searches = []
+        for search_id, rows in itertools.groupby(cursor.fetchall(), key=lambda row: row[0]):
+            rows = list(rows)
+            filters = {}
+            for row in rows:
+                if row[4] is None: continue # Search without filters (LEFT JOIN miss)
+                if row[6]:
+                    try: filters[row[4]] = json.loads(row[5])
+                    except (json.JSONDecodeError, TypeError): continue
+                else: filters[row[4]] = row[5]
+            first = rows[0]
+            searches.append({'id': search_id, 'name': first[1], 'search_term': first[2], 'filters': filters, 'created_at': first[3]})
+        return searches
 
     def delete_saved_search(self, search_id: int):
         with self._lock:
             conn = self._get_conn()
             conn.execute("DELETE FROM saved_searches WHERE id = ?", (search_id,))
-            conn.commit()
 
     # --- Favorites Methods ---
-    def _get_favorite_by_id(self, favorite_id: int) -> Optional[Dict[str, Any]]:
-         """Internal helper to fetch a favorite by its ID."""
-         conn = self._get_conn()
-         cursor = conn.execute(""" SELECT f.id, f.item_type, f.stencil_path, f.shape_id, f.added_at, st.name as stencil_name, sh.name as shape_name
-                                   FROM favorites f JOIN stencils st ON f.stencil_path = st.path LEFT JOIN shapes sh ON f.shape_id = sh.id AND f.item_type = 'shape'
-                                   WHERE f.id = ? """, (favorite_id,))
-         row = cursor.fetchone()
-         return dict(row) if row else None
+    # The no-op DO UPDATE makes RETURNING yield the row whether it was inserted or already present,
+    # and the scalar subqueries return the same shape as get_favorites() in that one statement
+    _FAVORITE_RETURNING = """ RETURNING id, item_type, stencil_path, shape_id, added_at,
+                              (SELECT name FROM stencils WHERE path = favorites.stencil_path) AS stencil_name,
+                              (SELECT name FROM shapes WHERE id = favorites.shape_id) AS shape_name """
+
+    def _upsert_favorite(self, sql: str, params: tuple) -> Optional[Dict[str, Any]]:
+        """Run a favorites upsert and return the favorite dict, or None when the target does not exist."""
+        with self._lock:
+            self._fav_cache = None
+            conn = self._get_conn()
+            row = self._row_cursor(conn).execute(sql + self._FAVORITE_RETURNING, params).fetchone()
+            return dict(row) if row else None
 
     def add_favorite_stencil(self, stencil_path: str) -> Optional[Dict[str, Any]]:
         """Add a stencil to favorites and return the created/existing item"""
-        with self._lock:
-            conn = self._get_conn(); cursor = conn.cursor(); fav_id = None
-            try:
-                cursor.execute(""" INSERT INTO favorites (item_type, stencil_path, shape_id) VALUES ('stencil', ?, NULL)
-                                   ON CONFLICT(stencil_path) WHERE item_type = 'stencil' DO NOTHING """, (stencil_path,))
-                if cursor.rowcount > 0: fav_id = cursor.lastrowid; print(f"Favorited stencil: {stencil_path} with new ID: {fav_id}")
-                else:
-                     existing = conn.execute("SELECT id FROM favorites WHERE item_type = 'stencil' AND stencil_path = ?", (stencil_path,)).fetchone()
-                     if existing: fav_id = existing['id']; print(f"Stencil {stencil_path} was already favorited with ID: {fav_id}")
-                conn.commit()
-                return self._get_favorite_by_id(fav_id) if fav_id else None
-            except sqlite3.IntegrityError as e: print(f"Error adding favorite stencil {stencil_path}: Stencil path missing? {e}"); conn.rollback(); return None
-            except Exception as e: print(f"Error adding favorite stencil {stencil_path}: {e}"); conn.rollback(); raise
+        try:
+            # Selecting from stencils turns a missing path into zero rows instead of an FK IntegrityError
+            favorite = self._upsert_favorite(""" INSERT INTO favorites (item_type, stencil_path, shape_id) SELECT 'stencil', path, NULL FROM stencils WHERE path = ?
+                                                 ON CONFLICT(stencil_path) WHERE item_type = 'stencil' DO UPDATE SET stencil_path = excluded.stencil_path """, (stencil_path,))
+        except Exception as e: logger.error("Error adding favorite stencil %s: %s", stencil_path, e); raise
+        if favorite: logger.debug("Favorited stencil: %s with ID: %s", stencil_path, favorite['id'])
+        else: logger.warning("Error adding favorite stencil %s: Stencil path missing?", stencil_path)
+        return favorite
 
     def add_favorite_shape_by_id(self, stencil_path: str, shape_id: int) -> Optional[Dict[str, Any]]:
         """Add a shape to favorites by ID and return the created/existing item"""
-        with self._lock:
-            conn = self._get_conn(); cursor = conn.cursor(); fav_id = None
-            try:
-                shape_exists = conn.execute("SELECT 1 FROM shapes WHERE id = ? AND stencil_path = ?", (shape_id, stencil_path)).fetchone()
-                if not shape_exists: print(f"Shape ID {shape_id} not found in stencil {stencil_path}"); return None
-                cursor.execute(""" INSERT INTO favorites (item_type, stencil_path, shape_id) VALUES ('shape', ?, ?)
-                                   ON CONFLICT(shape_id) WHERE item_type = 'shape' DO NOTHING """, (stencil_path, shape_id))
-                if cursor.rowcount > 0: fav_id = cursor.lastrowid; print(f"Favorited shape ID: {shape_id} with new Fav ID: {fav_id}")
-                else:
-                    existing = conn.execute("SELECT id FROM favorites WHERE item_type = 'shape' AND shape_id = ?", (shape_id,)).fetchone()
-                    if existing: fav_id = existing['id']; print(f"Shape ID {shape_id} was already favorited with Fav ID: {fav_id}")
-                conn.commit()
-                return self._get_favorite_by_id(fav_id) if fav_id else None
-            except sqlite3.IntegrityError as e: print(f"Error adding favorite shape ID {shape_id}: FK violation? {e}"); conn.rollback(); return None
-            except Exception as e: print(f"Error adding favorite shape ID {shape_id}: {e}"); conn.rollback(); raise
+        try:
+            # Existence check and insert in one statement: a shape outside stencil_path yields no row to insert
+            favorite = self._upsert_favorite(""" INSERT INTO favorites (item_type, stencil_path, shape_id) SELECT 'shape', stencil_path, id FROM shapes WHERE id = ? AND stencil_path = ?
+                                                 ON CONFLICT(shape_id) WHERE item_type = 'shape' AND shape_id IS NOT NULL DO UPDATE SET shape_id = excluded.shape_id """, (shape_id, stencil_path))
+        except Exception as e: logger.error("Error adding favorite shape ID %s: %s", shape_id, e); raise
+        if favorite: logger.debug("Favorited shape ID: %s with Fav ID: %s", shape_id, favorite['id'])
+        else: logger.warning("Shape ID %s not found in stencil %s", shape_id, stencil_path)
+        return favorite
 
     def remove_favorite(self, favorite_id: int) -> bool:
         """Remove an item from favorites by its ID. Returns True if removed, False otherwise."""
         with self._lock:
+            self._fav_cache = None
             conn = self._get_conn(); cursor = conn.cursor()
             cursor.execute("DELETE FROM favorites WHERE id = ?", (favorite_id,))
             removed_count = cursor.rowcount
-            conn.commit()
-            if removed_count > 0: print(f"Removed favorite ID: {favorite_id}"); return True
-            else: print(f"Favorite ID {favorite_id} not found for removal."); return False
+            if removed_count > 0: logger.debug("Removed favorite ID: %s", favorite_id); return True
+            else: logger.info("Favorite ID %s not found for removal.", favorite_id); return False
 
     def remove_favorite_stencil(self, stencil_path: str):
         """Remove a stencil from favorites by its path."""
         with self._lock:
+            self._fav_cache = None
             conn = self._get_conn()
             conn.execute("DELETE FROM favorites WHERE item_type = 'stencil' AND stencil_path = ?", (stencil_path,))
-            conn.commit()
 
     def remove_favorite_shape(self, shape_id: int):
          """Remove a shape from favorites by its shape ID."""
          with self._lock:
+            self._fav_cache = None
             conn = self._get_conn()
             conn.execute("DELETE FROM favorites WHERE item_type = 'shape' AND shape_id = ?", (shape_id,))
-            conn.commit()
 
     def get_favorites(self) -> List[Dict[str, Any]]:
         """Retrieve all favorite items (stencils and shapes)."""
-        with self._lock:
-            conn = self._get_conn()
-            cursor = conn.execute("""
-                SELECT f.id, f.item_type, f.stencil_path, f.shape_id, f.added_at, st.name as stencil_name, sh.name as shape_name
-                FROM favorites f JOIN stencils st ON f.stencil_path = st.path LEFT JOIN shapes sh ON f.shape_id = sh.id AND f.item_type = 'shape'
-                ORDER BY f.added_at DESC """)
-            return [dict(row) for row in cursor.fetchall()]
+        conn = self._get_conn()
+        cursor = conn.execute("""
+            SELECT f.id, f.item_type, f.stencil_path, f.shape_id, f.added_at, st.name as stencil_name, sh.name as shape_name
+            FROM favorites f JOIN stencils st ON f.stencil_path = st.path LEFT JOIN shapes sh ON f.shape_id = sh.id AND f.item_type = 'shape'
+            ORDER BY f.added_at DESC """)
+        cols = [d[0] for d in cursor.description]
+        return [dict(zip(cols, row)) for row in cursor.fetchall()]
+
+    def _favorite_sets(self):
+        """
+        Return (stencil paths, shape ids) of all favorites, loaded with one query and cached.
+        The cache is dropped by this instance's favorite writes; PRAGMA data_version catches
+        commits made by any other connection (other threads or processes) without reading a table.
+        """
+        conn = self._get_conn()
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        cache = self._fav_cache
+        if cache is None or cache[0] is not conn or cache[1] != data_version:
+            stencil_paths, shape_ids = set(), set()
+            for item_type, stencil_path, shape_id in conn.execute("SELECT item_type, stencil_path, shape_id FROM favorites"):
+                if item_type == 'stencil': stencil_paths.add(stencil_path)
+                elif shape_id is not None: shape_ids.add(shape_id)
+            cache = self._fav_cache = (conn, data_version, stencil_paths, shape_ids)
+        return cache[2], cache[3]
+
+    def get_favorite_stencil_paths(self) -> Set[str]:
+        """Paths of all favorited stencils, for O(1) membership checks while rendering results."""
+        return set(self._favorite_sets()[0])
+
+    def get_favorite_shape_ids(self) -> Set[int]:
+        """IDs of all favorited shapes, for O(1) membership checks while rendering results."""
+        return set(self._favorite_sets()[1])
 
     def is_favorite_stencil(self, stencil_path: str) -> bool:
         """Check if a stencil is favorited."""
-        with self._lock:
-            conn = self._get_conn()
-            cursor = conn.execute("SELECT 1 FROM favorites WHERE item_type = 'stencil' AND stencil_path = ?", (stencil_path,))
-            return cursor.fetchone() is not None
+        return stencil_path in self._favorite_sets()[0]
 
     def is_favorite_shape(self, shape_id: int) -> bool:
         """Check if a specific shape is favorited by its ID."""
-        with self._lock:
-            conn = self._get_conn()
-            cursor = conn.execute("SELECT 1 FROM favorites WHERE item_type = 'shape' AND shape_id = ?", (shape_id,))
-            return cursor.fetchone() is not None
+        return shape_id in self._favorite_sets()[1]
+
+    def are_favorite_stencils(self, stencil_paths) -> Set[str]:
+        """The favorited subset of stencil_paths, e.g. to badge a whole results page with one cache lookup."""
+        return self._favorite_sets()[0].intersection(stencil_paths)
+
+    def are_favorite_shapes(self, shape_ids) -> Set[int]:
+        """The favorited subset of shape_ids, e.g. to badge a whole results page with one cache lookup."""
+        return self._favorite_sets()[1].intersection(shape_ids)
 
     # --- Preset Directory Methods ---
     def add_preset_directory(self, path: str, name: str = None) -> bool:
@@ -497,41 +1047,35 @@ class StencilDatabase:
         with self._lock:
             conn = self._get_conn()
             try:
-                cursor = conn.execute("INSERT INTO preset_directories (path, name) VALUES (?, ?)", (path, name))
-                conn.commit(); print(f"Added preset directory: {name} ({path}) ID: {cursor.lastrowid}"); return True
-            except sqlite3.IntegrityError: print(f"Preset path already exists: {path}"); return False
-            except Exception as e: print(f"Error adding preset directory: {e}"); conn.rollback(); return False
+                cursor = conn.execute("INSERT INTO preset_directories (path, name) VALUES (?, ?) ON CONFLICT(path) DO NOTHING", (path, name))
+                if cursor.rowcount == 0: logger.info("Preset path already exists: %s", path); return False
+                logger.debug("Added preset directory: %s (%s) ID: %s", name, path, cursor.lastrowid); return True
+            except Exception as e: logger.error("Error adding preset directory: %s", e); return False
 
     def get_preset_directories(self) -> List[Dict[str, Any]]:
-        with self._lock:
-            conn = self._get_conn()
-            cursor = conn.execute("SELECT id, path, name, is_active FROM preset_directories ORDER BY name")
-            return [dict(row) for row in cursor.fetchall()]
+        conn = self._get_conn()
+        cursor = self._row_cursor(conn).execute("SELECT id, path, name, is_active FROM preset_directories ORDER BY name")
+        return [dict(row) for row in cursor.fetchall()]
 
-    def get_active_directory(self) -> Optional[Dict[str, Any]]:
-         with self._lock:
-             conn = self._get_conn()
-             cursor = conn.execute("SELECT id, path, name FROM preset_directories WHERE is_active = 1 LIMIT 1")
-             row = cursor.fetchone(); return dict(row) if row else None
+    def get_active_directory(self) -> Optional[sqlite3.Row]:
+         """Get the active preset directory as a Row (supports key and index access)."""
+         conn = self._get_conn()
+         cursor = self._row_cursor(conn).execute("SELECT id, path, name FROM preset_directories WHERE is_active = 1 LIMIT 1")
+         return cursor.fetchone()
 
     def set_active_directory(self, directory_id: int) -> bool:
         """Set the active directory"""
         with self._lock:
             conn = self._get_conn()
             try:
-                # Remove explicit transaction management
-                # conn.execute("BEGIN TRANSACTION") 
-                # Set all directories to inactive first
-                conn.execute("UPDATE preset_directories SET is_active = 0")
-                # Set the specified directory to active
-                result = conn.execute("UPDATE preset_directories SET is_active = 1 WHERE id = ?", (directory_id,))
-                # Commit removed - rely on implicit transaction/autocommit
-                # conn.execute("COMMIT") 
+                # One pass: activate the target and deactivate the previous one, leaving other rows untouched.
+                # An unknown id matches nothing, so the current active directory is kept.
+                result = conn.execute("""UPDATE preset_directories SET is_active = CASE WHEN id = ? THEN 1 ELSE 0 END
+                                         WHERE (is_active = 1 OR id = ?) AND EXISTS (SELECT 1 FROM preset_directories WHERE id = ?)""",
+                                      (directory_id, directory_id, directory_id))
                 return result.rowcount > 0
             except sqlite3.Error as e:
-                print(f"Error setting active directory: {e}")
-                # Rollback removed as no explicit transaction started
-                # conn.rollback() 
+                logger.error("Error setting active directory: %s", e)
                 return False
 
     def remove_preset_directory(self, directory_id: int) -> bool:
@@ -539,9 +1083,8 @@ class StencilDatabase:
             conn = self._get_conn(); cursor = conn.cursor()
             cursor.execute("DELETE FROM preset_directories WHERE id = ?", (directory_id,))
             removed = cursor.rowcount > 0
-            conn.commit()
-            if removed: print(f"Removed preset directory ID: {directory_id}")
-            else: print(f"Preset directory ID {directory_id} not found.")
+            if removed: logger.debug("Removed preset directory ID: %s", directory_id)
+            else: logger.info("Preset directory ID %s not found.", directory_id)
             return removed
 
     # --- Collections Methods ---
@@ -550,382 +1093,450 @@ class StencilDatabase:
         with self._lock:
             conn = self._get_conn(); cursor = conn.cursor()
             try:
-                now = datetime.now().isoformat()
-                cursor.execute("INSERT INTO collections (name, created_at, updated_at) VALUES (?, ?, ?)", (name, now, now))
-                collection_id = cursor.lastrowid
-                conn.commit()
-                print(f"Created collection '{name}' with ID: {collection_id}")
+                with self._transaction(conn):
+                    # 'now' is fixed for the duration of a statement, so both columns get the same timestamp
+                    cursor.execute(f"INSERT INTO collections (name, created_at, updated_at) VALUES (?, {_SQL_NOW}, {_SQL_NOW})", (name,))
+                    collection_id = cursor.lastrowid
+                logger.debug("Created collection '%s' with ID: %s", name, collection_id)
                 # Fetch the created collection to return it
                 return self.get_collection_details(collection_id) # Return full details
-            except sqlite3.IntegrityError: print(f"Collection name '{name}' already exists."); conn.rollback(); return None
-            except Exception as e: print(f"Error creating collection '{name}': {e}"); conn.rollback(); raise
+            except sqlite3.IntegrityError: logger.info("Collection name '%s' already exists.", name); return None
+            except Exception as e: logger.error("Error creating collection '%s': %s", name, e); raise
 
     def get_collections(self) -> List[Dict[str, Any]]:
         """Retrieves all collections with shape counts."""
-        with self._lock:
-            conn = self._get_conn()
-            query = """ SELECT c.id, c.name, c.created_at, c.updated_at, COUNT(cs.shape_id) as shape_count
-                        FROM collections c LEFT JOIN collection_shapes cs ON c.id = cs.collection_id
-                        GROUP BY c.id ORDER BY c.name """
-            cursor = conn.execute(query)
-            return [dict(row) for row in cursor.fetchall()]
+        conn = self._get_conn()
+        query = "SELECT id, name, created_at, updated_at, shape_count FROM collections ORDER BY name"
+        cursor = conn.execute(query)
+        cols = [d[0] for d in cursor.description]
+        return [dict(zip(cols, row)) for row in cursor]
 
     def get_collection_details(self, collection_id: int) -> Optional[Dict[str, Any]]:
         """Retrieves collection details including its shapes."""
-        with self._lock:
-            conn = self._get_conn()
-            coll_cursor = conn.execute("SELECT id, name, created_at, updated_at FROM collections WHERE id = ?", (collection_id,))
-            collection_data = coll_cursor.fetchone()
-            if not collection_data: return None
-            shapes_query = """ SELECT s.id as shape_id, s.name as shape_name, s.stencil_path, st.name as stencil_name
-                               FROM collection_shapes cs JOIN shapes s ON cs.shape_id = s.id JOIN stencils st ON s.stencil_path = st.path
-                               WHERE cs.collection_id = ? ORDER BY cs.added_at DESC """
-            shapes_cursor = conn.execute(shapes_query, (collection_id,))
-            shapes = [dict(row) for row in shapes_cursor.fetchall()]
-            result = dict(collection_data); result['shapes'] = shapes
-            return result
+        conn = self._get_conn()
+        collection_data = conn.execute("SELECT id, name, created_at, updated_at FROM collections WHERE id = ?", (collection_id,)).fetchone()
+        if not collection_data: return None
+        shapes_query = """ SELECT s.id as shape_id, s.name as shape_name, s.stencil_path, st.name as stencil_name
+                           FROM collection_shapes cs JOIN shapes s ON cs.shape_id = s.id JOIN stencils st ON s.stencil_path = st.path
+                           WHERE cs.collection_id = ? ORDER BY cs.added_at DESC """
+        # Plain tuples zipped with the column names once, instead of sqlite3.Row objects converted per row
+        shapes_cursor = conn.execute(shapes_query, (collection_id,))
+        cols = [d[0] for d in shapes_cursor.description]
+        result = dict(zip(('id', 'name', 'created_at', 'updated_at'), collection_data))
+        result['shapes'] = [dict(zip(cols, row)) for row in shapes_cursor]
+        return result
 
     def add_shape_to_collection(self, collection_id: int, shape_id: int) -> bool:
         """Adds a shape to a collection. Returns True on success/already exists, False on error."""
         with self._lock:
-            conn = self._get_conn(); cursor = conn.cursor()
+            conn = self._get_conn()
             try:
-                coll_exists = conn.execute("SELECT 1 FROM collections WHERE id = ?", (collection_id,)).fetchone()
-                shape_exists = conn.execute("SELECT 1 FROM shapes WHERE id = ?", (shape_id,)).fetchone()
-                if not coll_exists or not shape_exists: print(f"Collection {collection_id} or Shape {shape_id} not found."); return False
-                cursor.execute("INSERT OR IGNORE INTO collection_shapes (collection_id, shape_id) VALUES (?, ?)", (collection_id, shape_id))
-                inserted = cursor.rowcount > 0
-                if inserted: conn.execute("UPDATE collections SET updated_at = ? WHERE id = ?", (datetime.now().isoformat(), collection_id))
-                conn.commit()
-                if inserted: print(f"Added shape {shape_id} to collection {collection_id}")
-                else: print(f"Shape {shape_id} already in collection {collection_id}")
+                with self._transaction(conn):
+                    # The foreign keys reject a missing collection or shape; OR IGNORE only covers the duplicate case
+                    inserted = conn.execute("INSERT OR IGNORE INTO collection_shapes (collection_id, shape_id) VALUES (?, ?)", (collection_id, shape_id)).rowcount > 0
+                    if inserted: conn.execute(_SQL_TOUCH_COLLECTION, (collection_id,))
+                if inserted: logger.debug("Added shape %s to collection %s", shape_id, collection_id)
+                else: logger.debug("Shape %s already in collection %s", shape_id, collection_id)
                 return True
-            except Exception as e: print(f"Error adding shape {shape_id} to collection {collection_id}: {e}"); conn.rollback(); return False
+            except sqlite3.IntegrityError: logger.info("Collection %s or Shape %s not found.", collection_id, shape_id); return False
+            except Exception as e: logger.error("Error adding shape %s to collection %s: %s", shape_id, collection_id, e); return False
+
+    def add_shapes_to_collection(self, collection_id: int, shape_ids: List[int]) -> int:
+        """
+        Add many shapes to a collection in one statement and one transaction. Unknown or already
+        present shape ids are skipped. Returns the number of shapes added (0 if the collection doesn't exist).
+        """
+        if not shape_ids: return 0
+        with self._lock:
+            conn = self._get_conn()
+            try:
+                with self._transaction(conn):
+                    added = conn.execute(_SQL_ADD_COLLECTION_SHAPES, (collection_id, json.dumps(list(shape_ids)))).rowcount
+                    if added: conn.execute(_SQL_TOUCH_COLLECTION, (collection_id,))
+                logger.debug("Added %s of %s shapes to collection %s", added, len(shape_ids), collection_id)
+                return added
+            except sqlite3.IntegrityError: logger.info("Collection %s not found.", collection_id); return 0
+            except Exception as e: logger.error("Error adding shapes to collection %s: %s", collection_id, e); return 0
 
     def remove_shape_from_collection(self, collection_id: int, shape_id: int) -> bool:
         """Removes a shape from a collection. Returns True if removed, False otherwise."""
         with self._lock:
-            conn = self._get_conn(); cursor = conn.cursor()
+            conn = self._get_conn()
             try:
-                cursor.execute("DELETE FROM collection_shapes WHERE collection_id = ? AND shape_id = ?", (collection_id, shape_id))
-                removed = cursor.rowcount > 0
-                if removed: conn.execute("UPDATE collections SET updated_at = ? WHERE id = ?", (datetime.now().isoformat(), collection_id))
-                conn.commit()
-                if removed: print(f"Removed shape {shape_id} from collection {collection_id}")
-                else: print(f"Shape {shape_id} not found in collection {collection_id}")
+                with self._transaction(conn):
+                    removed = conn.execute("DELETE FROM collection_shapes WHERE collection_id = ? AND shape_id = ?", (collection_id, shape_id)).rowcount > 0
+                    if removed: conn.execute(_SQL_TOUCH_COLLECTION, (collection_id,))
+                if removed: logger.debug("Removed shape %s from collection %s", shape_id, collection_id)
+                else: logger.info("Shape %s not found in collection %s", shape_id, collection_id)
                 return removed
-            except Exception as e: print(f"Error removing shape {shape_id} from collection {collection_id}: {e}"); conn.rollback(); return False
+            except Exception as e: logger.error("Error removing shape %s from collection %s: %s", shape_id, collection_id, e); return False
 
     def update_collection(self, collection_id: int, name: Optional[str] = None,
                           add_shape_ids: Optional[List[int]] = None,
                           remove_shape_ids: Optional[List[int]] = None) -> Optional[Dict[str, Any]]:
         """Updates a collection's name and/or shape associations."""
         with self._lock:
-            conn = self._get_conn(); cursor = conn.cursor()
+            conn = self._get_conn()
             try:
-                if not conn.execute("SELECT id FROM collections WHERE id = ?", (collection_id,)).fetchone(): return None
-                conn.execute("BEGIN TRANSACTION")
-                updated = False; now_iso = datetime.now().isoformat()
-                if name is not None:
-                    cursor.execute("UPDATE collections SET name = ?, updated_at = ? WHERE id = ?", (name, now_iso, collection_id)); updated = True
-                if remove_shape_ids:
-                    placeholders = ','.join('?'*len(remove_shape_ids)); sql = f"DELETE FROM collection_shapes WHERE collection_id = ? AND shape_id IN ({placeholders})"
-                    params = [collection_id] + remove_shape_ids; cursor.execute(sql, params)
-                    if cursor.rowcount > 0: updated = True
-                if add_shape_ids:
-                    added_count = 0
-                    # Check shape existence efficiently
-                    placeholders = ','.join('?'*len(add_shape_ids))
-                    valid_shape_ids = {row['id'] for row in conn.execute(f"SELECT id FROM shapes WHERE id IN ({placeholders})", add_shape_ids)}
-                    shapes_to_add = []
-                    for shape_id in add_shape_ids:
-                        if shape_id in valid_shape_ids: shapes_to_add.append((collection_id, shape_id))
-                        else: print(f"Warning: Shape ID {shape_id} not found, cannot add.")
-                    if shapes_to_add:
-                         cursor.executemany("INSERT OR IGNORE INTO collection_shapes (collection_id, shape_id) VALUES (?, ?)", shapes_to_add)
-                         # executemany might return -1, so just assume updated if we tried adding
-                         added_count = len(shapes_to_add) # Use length of attempt list instead of rowcount
-                    if added_count > 0: updated = True
-                if updated and name is None: cursor.execute("UPDATE collections SET updated_at = ? WHERE id = ?", (now_iso, collection_id))
-                conn.commit(); print(f"Updated collection {collection_id}")
+                # One BEGIN IMMEDIATE for the whole update: the existence check and every write see the same snapshot
+                with self._transaction(conn):
+                    if not conn.execute("SELECT id FROM collections WHERE id = ?", (collection_id,)).fetchone(): return None
+                    updated = name is not None
+                    if remove_shape_ids:
+                        if conn.execute(_SQL_REMOVE_COLLECTION_SHAPES, (collection_id, json.dumps(list(remove_shape_ids)))).rowcount > 0: updated = True
+                    if add_shape_ids:
+                        # Validation and insert in one statement: ids with no shape row simply select nothing
+                        added_count = conn.execute(_SQL_ADD_COLLECTION_SHAPES, (collection_id, json.dumps(list(add_shape_ids)))).rowcount
+                        skipped = len(set(add_shape_ids)) - added_count
+                        if skipped: logger.warning("%s shape ID(s) not added (not found or already in collection %s).", skipped, collection_id)
+                        if added_count > 0: updated = True
+                    # One write to the collection row covers both the rename and the updated_at touch
+                    if updated: conn.execute(f"UPDATE collections SET name = COALESCE(?, name), updated_at = {_SQL_NOW} WHERE id = ?", (name, collection_id))
+                logger.debug("Updated collection %s", collection_id)
                 return self.get_collection_details(collection_id)
-            except sqlite3.IntegrityError as e: print(f"Error updating collection {collection_id}: Integrity constraint (name '{name}'?). {e}"); conn.rollback(); return None
-            except Exception as e: print(f"Error updating collection {collection_id}: {e}"); traceback.print_exc(); conn.rollback(); raise
+            except sqlite3.IntegrityError as e: logger.error("Error updating collection %s: Integrity constraint (name '%s'?). %s", collection_id, name, e); return None
+            except Exception as e: logger.exception("Error updating collection %s: %s", collection_id, e); raise
 
     def delete_collection(self, collection_id: int) -> bool:
         """Deletes a collection and its associations."""
         with self._lock:
             conn = self._get_conn(); cursor = conn.cursor()
             try:
-                cursor.execute("DELETE FROM collections WHERE id = ?", (collection_id,))
-                deleted = cursor.rowcount > 0
-                conn.commit() # Associations deleted by ON DELETE CASCADE
-                if deleted: print(f"Deleted collection ID: {collection_id}")
-                else: print(f"Collection ID {collection_id} not found.")
+                with self._transaction(conn): # The ON DELETE CASCADE of its associations commits or rolls back with it
+                    cursor.execute("DELETE FROM collections WHERE id = ?", (collection_id,))
+                    deleted = cursor.rowcount > 0
+                if deleted: logger.debug("Deleted collection ID: %s", collection_id)
+                else: logger.info("Collection ID %s not found.", collection_id)
                 return deleted
-            except Exception as e: print(f"Error deleting collection {collection_id}: {e}"); conn.rollback(); return False
+            except Exception as e: logger.error("Error deleting collection %s: %s", collection_id, e); return False
     # --- END: Collections Methods ---
 
     # --- Other Methods ---
     def clear_cache(self):
         """Clear all cached stencil, shape, favorite, and collection data."""
+        # One script, one transaction. The per-row delete triggers are dropped for the wipe: unqualified
+        # DELETEs on trigger-free tables take SQLite's truncate path, the FTS index is emptied in a single
+        # 'delete-all', and shape_count needs no upkeep on rows being deleted anyway. DDL is transactional,
+        # so a failure restores the triggers with everything else.
+        script = ";\n".join([
+            "BEGIN IMMEDIATE",
+            "DROP TRIGGER IF EXISTS shapes_ad",
+            "DROP TRIGGER IF EXISTS collection_shapes_ad",
+            "DELETE FROM collection_shapes",
+            "DELETE FROM collections",
+            "DELETE FROM favorites",
+            "DELETE FROM shapes",
+            "DELETE FROM stencils",
+            _FTS_TRIGGERS_SQL['shapes_ad'],
+            _COLLECTION_TRIGGERS_SQL['collection_shapes_ad'],
+            "INSERT INTO shapes_fts(shapes_fts) VALUES('delete-all')",
+            "COMMIT;",
+        ])
         with self._lock:
+            self._fav_cache = None
             conn = self._get_conn()
             try:
-                conn.execute("BEGIN TRANSACTION")
-                conn.execute("DELETE FROM collection_shapes")
-                conn.execute("DELETE FROM collections")
-                conn.execute("DELETE FROM favorites")
-                conn.execute("DELETE FROM shapes") # Triggers will clear FTS
-                conn.execute("DELETE FROM stencils")
-                conn.commit()
-                print("Cleared stencil, shape, favorite, and collection cache.")
-            except Exception as e: print(f"Error clearing cache: {e}"); conn.rollback()
+                conn.executescript(script)
+                logger.info("Cleared stencil, shape, favorite, and collection cache.")
+            except Exception as e:
+                logger.error("Error clearing cache: %s", e)
+                if conn.in_transaction: conn.execute("ROLLBACK")
 
-    def close(self):
-        """Close database connection"""
-        if self._conn: self._conn.close(); self._conn = None; print("Database connection closed.")
+    def verify_fts(self) -> bool:
+        """
+        Offline check that shapes_fts matches the shapes table; runs a native rebuild if it doesn't.
+        Returns True if the index was already consistent. The triggers keep it in sync during
+        normal use, so this is only needed after manual edits or an interrupted rebuild.
+        """
+        with self._lock:
+            conn = self._get_conn()
+            try:
+                # rank=1 compares the index against the external content table, not just its own structure
+                conn.execute("INSERT INTO shapes_fts(shapes_fts, rank) VALUES('integrity-check', 1)")
+                return True
+            except sqlite3.DatabaseError as e:
+                logger.warning("FTS index out of sync with shapes (%s). Rebuilding FTS index...", e)
+                conn.execute("INSERT INTO shapes_fts(shapes_fts) VALUES('rebuild')")
+                return False
+
+    def _fts_table_exists(self, conn: sqlite3.Connection) -> bool:
+        """Whether shapes_fts exists; a metadata-only lookup, cached until the schema may have changed."""
+        if self._has_fts is None:
+            self._has_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='shapes_fts'").fetchone() is not None
+        return self._has_fts
 
     def rebuild_fts_index(self):
-        """Rebuild the FTS index if needed"""
+        """Rebuild the FTS index from the shapes table and merge it into a single segment."""
         with self._lock:
             conn = self._get_conn()
+            self._has_fts = None
             try:
-                print("Rebuilding FTS index...")
-                if conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='shapes_fts'").fetchone():
-                    conn.execute("INSERT INTO shapes_fts(shapes_fts) VALUES('rebuild')"); print("Issued FTS rebuild command.")
-                else: print("FTS table does not exist, skipping rebuild.")
-                conn.commit()
-            except Exception as e: print(f"Error rebuilding FTS index: {e}"); conn.rollback()
+                logger.info("Rebuilding FTS index...")
+                if self._fts_table_exists(conn):
+                    # Both run inside SQLite: 'rebuild' discards the old index and re-reads the external content
+                    # table, 'optimize' merges segments. One write transaction, so readers never see it half-built.
+                    with self._transaction(conn):
+                        conn.execute("INSERT INTO shapes_fts(shapes_fts) VALUES('rebuild')")
+                        conn.execute("INSERT INTO shapes_fts(shapes_fts) VALUES('optimize')")
+                    conn.execute("PRAGMA optimize") # Re-plan search joins against the rebuilt index's stats
+                    logger.info("Issued FTS rebuild and optimize commands.")
+                else: logger.info("FTS table does not exist, skipping rebuild.")
+            except Exception as e:
+                logger.error("Error rebuilding FTS index: %s", e)
 
     def _recover_database(self):
         """Attempt to recover from a corrupted database file by dumping and reloading."""
-        print("Attempting database recovery...")
-        backup_path = f"{self.db_path}.corrupt_backup.{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        dump_path = f"{self.db_path}.sql_dump"
+        logger.warning("Attempting database recovery...")
+        backup_path = f"{self.db_path}.corrupt_backup.{time.time_ns()}"
         try:
-            if self.db_path.exists(): import shutil; shutil.move(str(self.db_path), backup_path); print(f"Moved corrupted DB to backup: {backup_path}")
-            print(f"Attempting to dump SQL from {backup_path} to {dump_path}...")
-            exit_code = os.system(f"sqlite3 \"{backup_path}\" .dump > \"{dump_path}\"")
-            if exit_code != 0 or not os.path.exists(dump_path) or os.path.getsize(dump_path) == 0:
-                 print("Failed to dump SQL. Recreating empty DB.");
-                 if os.path.exists(dump_path): os.remove(dump_path)
-                 return self._recreate_tables()
-            print("SQL dump created.")
-            if self._conn: self._conn.close(); self._conn = None
-            for suffix in ['-wal', '-shm']: wal_path = self.db_path.with_suffix(f"{self.db_path.suffix}{suffix}");
-            if wal_path.exists(): wal_path.unlink()
-            self._conn = None; conn = self._get_conn()
-            print(f"Importing data from {dump_path} into new database...")
-            with open(dump_path, 'r') as f: sql_script = f.read()
-            conn.executescript(sql_script); conn.commit()
-            os.remove(dump_path); print("Database recovery attempt finished.")
+            self._close_connections()
+            if self.db_path.exists(): shutil.move(str(self.db_path), backup_path); logger.info("Moved corrupted DB to backup: %s", backup_path)
+            # Stale -wal/-shm files belong to the corrupt DB that was just moved aside
+            for suffix in ('-wal', '-shm'): self.db_path.with_suffix(self.db_path.suffix + suffix).unlink(missing_ok=True)
+            conn = self._get_conn()
+            logger.info("Copying readable data from %s into new database...", backup_path)
+            # Dump the backup in-process (read-only) and replay it into the new DB in one transaction:
+            # no sqlite3 CLI dependency and no intermediate .sql file. FTS objects are skipped and rebuilt below.
+            src = sqlite3.connect(f"file:{backup_path}?mode=ro", uri=True)
+            try:
+                statements = (stmt for stmt in src.iterdump() if not _DUMP_SKIP_RE.match(stmt))
+                conn.execute("PRAGMA foreign_keys = OFF") # Tables are dumped by name, children before parents
+                with self._transaction(conn):
+                    for stmt in statements: # execute(), not executescript(): the latter would COMMIT first
+                        conn.execute(stmt)
+            finally:
+                src.close()
+                conn.execute("PRAGMA foreign_keys = ON")
+            logger.info("Database recovery attempt finished.")
             self._init_db_schema(conn) # Ensure schema is fully applied
             self.rebuild_fts_index()
             return True
-        except Exception as recovery_error: print(f"Database recovery process failed: {recovery_error}"); traceback.print_exc(); return self._recreate_tables()
+        except Exception as recovery_error: logger.exception("Database recovery process failed: %s", recovery_error); return self._recreate_tables()
 
-    def search_shapes(self, search_term: str, filters: dict = None, use_fts: bool = True, limit: int = 20, offset: int = 0, directory_filter: Optional[str] = None):
-        """Search shapes, optionally using FTS, with filters and pagination."""
-        with self._lock:
-            conn = self._get_conn()
-            cursor = conn.cursor()
-
-            # --- Add this block: Pre-check for file_size column ---
-            try:
-                stencils_cursor = conn.execute("PRAGMA table_info(stencils)")
-                stencils_columns = {row['name'] for row in stencils_cursor.fetchall()}
-                if 'file_size' not in stencils_columns:
-                    print("!!! 'file_size' column missing in search_shapes connection. Running migration...")
-                    # Run the migration logic specifically for this connection
-                    conn.execute("ALTER TABLE stencils ADD COLUMN file_size INTEGER")
-                    conn.commit()
-                    print("Migration applied within search_shapes.")
-            except Exception as migration_check_e:
-                print(f"Error checking/applying migration within search_shapes: {migration_check_e}")
-            # --- End of added block ---
-
-            query_params = {}
-            filter_clauses = []
-
-            # Normalize the directory filter path for reliable matching
-            normalized_directory_filter = None
-            if directory_filter:
-                normalized_directory_filter = os.path.normpath(directory_filter)
-                # Append wildcard for LIKE
-                query_params['directory_filter_pattern'] = f"{normalized_directory_filter}%"
-                # Add clause to filter by stencil path
-                filter_clauses.append("stencils.path LIKE :directory_filter_pattern")
-
-            # --- Standard Filters ---
-            if filters:
-                if filters.get('show_favorites'):
-                    # Join with favorites table and filter by item_type = 'stencil'
-                    filter_clauses.append("stencils.path IN (SELECT stencil_path FROM favorites WHERE item_type = 'stencil')")
-
-                # --- Date Filters ---
-                if filters.get('date_start'):
-                    query_params['date_start'] = filters['date_start'].isoformat()
-                    filter_clauses.append("stencils.last_modified >= :date_start")
-                if filters.get('date_end'):
-                    # Add one day and format to include the entire end day
-                    end_date_inclusive = filters['date_end'] + timedelta(days=1)
-                    query_params['date_end'] = end_date_inclusive.isoformat()
-                    filter_clauses.append("stencils.last_modified < :date_end")
-
-                # --- Size and Shape Count Filters (on stencils table) ---
-                # Only add clauses if the filter value is actually restrictive
-                if filters.get('min_size') is not None and filters['min_size'] > 0:
-                    query_params['min_size'] = filters['min_size']
-                    filter_clauses.append("stencils.file_size >= :min_size")
-                # Check against a sensible max default (e.g. 50MB * 1024 * 1024) or ensure it's less than a very large number
-                if filters.get('max_size') is not None and filters['max_size'] < (50 * 1024 * 1024): # Only add if less than default max
-                    query_params['max_size'] = filters['max_size']
-                    filter_clauses.append("stencils.file_size <= :max_size")
-                if filters.get('min_shapes') is not None and filters['min_shapes'] > 0:
-                    query_params['min_shapes'] = filters['min_shapes']
-                    filter_clauses.append("stencils.shape_count >= :min_shapes")
-                if filters.get('max_shapes') is not None and filters['max_shapes'] < 500: # Only add if less than default max
-                    query_params['max_shapes'] = filters['max_shapes']
-                    filter_clauses.append("stencils.shape_count <= :max_shapes")
-
-                # --- Shape Metadata Filters (on shapes table) ---
-                if filters.get('min_width') is not None and filters['min_width'] > 0:
-                    query_params['min_width'] = filters['min_width']
-                    filter_clauses.append("shapes.width >= :min_width")
-                if filters.get('max_width') is not None and filters['max_width'] > 0:
-                    query_params['max_width'] = filters['max_width']
-                    filter_clauses.append("shapes.width <= :max_width")
-                if filters.get('min_height') is not None and filters['min_height'] > 0:
-                    query_params['min_height'] = filters['min_height']
-                    filter_clauses.append("shapes.height >= :min_height")
-                if filters.get('max_height') is not None and filters['max_height'] > 0:
-                    query_params['max_height'] = filters['max_height']
-                    filter_clauses.append("shapes.height <= :max_height")
-                if filters.get('has_properties'):
-                    # Check if properties JSON is not NULL, empty object, or empty array
-                    filter_clauses.append("shapes.properties IS NOT NULL AND shapes.properties != '' AND shapes.properties != '[]' AND shapes.properties != '{}'")
-
-                # --- Property Name/Value Filters (requires JSON parsing) ---
-                # NOTE: These might be slow on large datasets without specific JSON indexing
-                # Consider adding generated columns or specific indexing if performance is critical.
-                prop_name = filters.get('property_name')
-                prop_value = filters.get('property_value')
-                if prop_name:
-                    # Check if the key exists in the properties JSON
-                    query_params['prop_name_pattern'] = f'%"{prop_name}"%:'
-                    filter_clauses.append("shapes.properties LIKE :prop_name_pattern")
-                if prop_value:
-                    # Check if the value exists in the properties JSON
-                    query_params['prop_value_pattern'] = f'%:{json.dumps(prop_value)}%'
-                    filter_clauses.append("shapes.properties LIKE :prop_value_pattern")
-
-            # Construct WHERE clause
-            where_clause = " AND ".join(filter_clauses) if filter_clauses else "1=1" # Use 1=1 if no filters
-
-            # --- FTS Search ---
-            if use_fts:
-                query_params['search_term_fts'] = search_term
-                # FTS query needs to join back to shapes and stencils to apply standard filters
-                # Use snippet function for highlighting
-                query = f"""
-                    SELECT
-                        s.id AS shape_id,
-                        s.name AS shape_name,
-                        st.name AS stencil_name,
-                        st.path AS stencil_path,
-                        s.width AS width,
-                        s.height AS height,
-                        s.geometry AS geometry,
-                        s.properties AS properties,
-                        snippet(shapes_fts, 1, '[HL]', '[/HL]', '...', 15) AS highlighted_name
-                    FROM shapes_fts f
-                    JOIN shapes s ON f.rowid = s.id
-                    JOIN stencils st ON s.stencil_path = st.path
-                    WHERE shapes_fts MATCH :search_term_fts AND {where_clause}
-                    ORDER BY rank
-                    LIMIT :limit OFFSET :offset
-                """
-            # --- Standard LIKE Search ---
-            else:
-                query_params['search_term_like'] = f"%{search_term}%"
-                query = f"""
-                    SELECT
-                        s.id AS shape_id,
-                        s.name AS shape_name,
-                        st.name AS stencil_name,
-                        st.path AS stencil_path,
-                        s.width AS width,
-                        s.height AS height,
-                        s.geometry AS geometry,
-                        s.properties AS properties,
-                        NULL AS highlighted_name -- No highlight for standard search
-                    FROM shapes s
-                    JOIN stencils st ON s.stencil_path = st.path
-                    WHERE s.name LIKE :search_term_like AND {where_clause}
-                    ORDER BY st.name, s.name
-                    LIMIT :limit OFFSET :offset
-                """
-
-            # Add limit and offset parameters
-            query_params['limit'] = limit
-            query_params['offset'] = offset
-
-            # --- DEBUG PRINT --- 
-            print(f"--- Executing DB Search Query ---")
-            print(f"Using FTS: {use_fts}")
-            print("SQL Query:")
-            print(query)
-            print(f"Parameters: {query_params}")
-            # --- END DEBUG PRINT --- 
-            try:
+    def _shape_count(self, conn: sqlite3.Connection) -> int:
+        """
+        Number of cached shapes, cached like _favorite_sets: PRAGMA data_version catches commits
+        by other connections and total_changes this connection's own writes.
+        """
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        cache = self._shape_count_cache
+        if cache is None or cache[0] is not conn or cache[1] != data_version or cache[2] != conn.total_changes:
+            count = conn.execute("SELECT COUNT(*) FROM shapes").fetchone()[0]
+            cache = self._shape_count_cache = (conn, data_version, conn.total_changes, count)
+        return cache[3]
+
+    def search_shape_names(self, query: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        Lightweight ranked FTS lookup returning only shape id, name and stencil path.
+        ORDER BY rank ... LIMIT lets FTS5 keep just the top `limit` matches instead of sorting them all.
+        Input trigram MATCH cannot answer (a word under 3 characters) is a name substring search, ordered by name.
+        """
+        if not query.strip(): return []
+        conn = self._get_conn()
+        if _fts_can_match(query):
+            cursor = conn.execute("""
+                SELECT s.id AS shape_id, s.name AS shape_name, s.stencil_path AS stencil_path
+                FROM shapes_fts f JOIN shapes s ON s.id = f.rowid
+                WHERE shapes_fts MATCH ? ORDER BY rank LIMIT ?""", (_fts_match_query(query), limit))
+        else:
+            cursor = conn.execute("""
+                SELECT s.id AS shape_id, s.name AS shape_name, s.stencil_path AS stencil_path
+                FROM shapes_fts f JOIN shapes s ON s.id = f.rowid
+                WHERE f.name LIKE ? ORDER BY s.name LIMIT ?""", (f"%{query}%", limit))
+        cols = [d[0] for d in cursor.description]
+        return [dict(zip(cols, row)) for row in cursor.fetchall()]
+
+    def search_shapes(self, search_term: str, filters: dict = None, use_fts: bool = True, limit: int = 20, offset: int = 0,
+                      directory_filter: Optional[str] = None, return_total: bool = False, with_highlights: bool = True):
+        """
+        Search shapes, optionally using FTS, with filters and pagination.
+        return_total=True returns (results, total matches ignoring limit/offset), counted by a window
+        function in the same query instead of a second COUNT query.
+        with_highlights=False skips building highlighted_name (left None), for callers that never render it.
+        """
+        # Read-only: no instance lock, each thread searches on its own WAL connection
+        conn = self._get_conn()
+        cursor = conn.cursor()
+
+        # The file_size migration runs once in _run_migrations; only the FTS table's presence is checked, and cached
+        has_fts = self._fts_table_exists(conn)
+        if use_fts and not has_fts:
+            logger.debug("FTS table not available, using standard search.")
+            use_fts = False
+
+        query_params = {}
+        filter_clauses = []
+
+        # Normalize the directory filter path for reliable matching
+        normalized_directory_filter = None
+        if directory_filter:
+            normalized_directory_filter = os.path.normpath(directory_filter)
+            # Append wildcard for LIKE
+            query_params['directory_filter_pattern'] = f"{normalized_directory_filter}%"
+            # Add clause to filter by stencil path
+            filter_clauses.append("st.path LIKE :directory_filter_pattern")
+
+        # --- Standard Filters ---
+        if filters:
+            if filters.get('show_favorites'):
+                # Join with favorites table and filter by item_type = 'stencil'
+                filter_clauses.append("st.path IN (SELECT stencil_path FROM favorites WHERE item_type = 'stencil')")
+
+            # --- Date Filters ---
+            if filters.get('date_start'):
+                query_params['date_start'] = int(datetime.combine(filters['date_start'], datetime.min.time()).timestamp())
+                filter_clauses.append("st.last_modified >= :date_start")
+            if filters.get('date_end'):
+                # Add one day and format to include the entire end day
+                end_date_inclusive = filters['date_end'] + timedelta(days=1)
+                query_params['date_end'] = int(datetime.combine(end_date_inclusive, datetime.min.time()).timestamp())
+                filter_clauses.append("st.last_modified < :date_end")
+
+            # --- Size and Shape Count Filters (on stencils table) ---
+            # Only add clauses if the filter value is actually restrictive
+            if filters.get('min_size') is not None and filters['min_size'] > 0:
+                query_params['min_size'] = filters['min_size']
+                filter_clauses.append("st.file_size >= :min_size")
+            # Check against a sensible max default (e.g. 50MB * 1024 * 1024) or ensure it's less than a very large number
+            if filters.get('max_size') is not None and filters['max_size'] < (50 * 1024 * 1024): # Only add if less than default max
+                query_params['max_size'] = filters['max_size']
+                filter_clauses.append("st.file_size <= :max_size")
+            if filters.get('min_shapes') is not None and filters['min_shapes'] > 0:
+                query_params['min_shapes'] = filters['min_shapes']
+                filter_clauses.append("st.shape_count >= :min_shapes")
+            if filters.get('max_shapes') is not None and filters['max_shapes'] < 500: # Only add if less than default max
+                query_params['max_shapes'] = filters['max_shapes']
+                filter_clauses.append("st.shape_count <= :max_shapes")
+
+            # --- Shape Metadata Filters (on shapes table) ---
+            if filters.get('min_width') is not None and filters['min_width'] > 0:
+                query_params['min_width'] = filters['min_width']
+                filter_clauses.append("s.width >= :min_width")
+            if filters.get('max_width') is not None and filters['max_width'] > 0:
+                query_params['max_width'] = filters['max_width']
+                filter_clauses.append("s.width <= :max_width")
+            if filters.get('min_height') is not None and filters['min_height'] > 0:
+                query_params['min_height'] = filters['min_height']
+                filter_clauses.append("s.height >= :min_height")
+            if filters.get('max_height') is not None and filters['max_height'] > 0:
+                query_params['max_height'] = filters['max_height']
+                filter_clauses.append("s.height <= :max_height")
+            if filters.get('has_properties'):
+                # Check if properties JSON is not NULL, empty object, or empty array
+                filter_clauses.append("s.properties IS NOT NULL AND s.properties != '' AND s.properties != '[]' AND s.properties != '{}'")
+
+            # --- Property Name/Value Filters (requires JSON parsing) ---
+            # NOTE: These might be slow on large datasets without specific JSON indexing
+            # Consider adding generated columns or specific indexing if performance is critical.
+            prop_name = filters.get('property_name')
+            prop_value = filters.get('property_value')
+            if prop_name:
+                # Check if the key exists in the properties JSON
+                query_params['prop_name_pattern'] = f'%"{prop_name}"%:'
+                filter_clauses.append("s.properties LIKE :prop_name_pattern")
+            if prop_value:
+                # Check if the value exists in the properties JSON
+                query_params['prop_value_pattern'] = f'%:{json.dumps(prop_value)}%'
+                filter_clauses.append("s.properties LIKE :prop_value_pattern")
+
+        if not (search_term or '').strip():
+            mode = 'all' # Nothing to match: list shapes without touching the name at all
+        elif use_fts and _fts_can_match(search_term):
+            mode = 'fts'
+            query_params['search_term_fts'] = _fts_match_query(search_term)
+            if filter_clauses:
+                # An exact total needs every match, so the candidate cap only applies to plain page fetches
+                capped = not return_total and limit >= 0 # A negative LIMIT means unlimited in SQLite
+                query_params['fts_candidate_limit'] = (limit + offset) * _FTS_FILTER_OVERFETCH if capped else -1
+        else:
+            # Substring search is answered by the trigram index via LIKE; scanning shapes is the last resort.
+            # Trigram MATCH never matches words under 3 characters, so FTS searches containing one come here too
+            mode = 'like' if has_fts else 'scan'
+            query_params['search_term_like'] = f"%{search_term}%"
+        # Listing everything: the total is just the shape count, so skip the window function over the whole join
+        total = self._shape_count(conn) if return_total and mode == 'all' and not filter_clauses else None
+        count_in_query = return_total and total is None
+        # The SQL text depends only on the branch and which filters are active, so it is built once per combination
+        query = _build_search_query(mode, tuple(filter_clauses), count_in_query, with_highlights)
+
+        # Add limit and offset parameters
+        query_params['limit'] = limit
+        query_params['offset'] = offset
+
+        logger.debug("Executing DB search query (FTS: %s):%s\nParameters: %s", use_fts, query, query_params)
+        try:
+            while True:
                 cursor.execute(query, query_params)
-                results = [
-                    {
-                        **dict(row), # Convert row object to dict
-                        'geometry': json.loads(row['geometry']) if row['geometry'] else [],
-                        'properties': json.loads(row['properties']) if row['properties'] else {}
-                    }
-                    for row in cursor.fetchall()
-                ]
-                return results
-            except sqlite3.OperationalError as e:
-                print(f"!!! Database search error: {e}")
-                if use_fts: # <-- Fallback if *any* OperationalError occurs during an FTS attempt
-                    print("OperationalError during FTS search. Attempting fallback to standard search.")
-                    # Remove the debug prints temporarily to avoid recursive printing on fallback
-                    # return self.search_shapes(search_term, filters, False, limit, offset, directory_filter)
-                    # Need to implement fallback carefully to avoid infinite loops if standard search also fails
-                    try:
-                        print("Retrying with standard search...")
-                        # Ensure use_fts is False for the recursive call
-                        return self.search_shapes(search_term, filters, False, limit, offset, directory_filter)
-                    except Exception as fallback_e:
-                        print(f"!!! Standard search fallback also failed: {fallback_e}")
-                        traceback.print_exc()
-                        return [] # Return empty on fallback failure
-                else:
-                    # Error occurred even during standard search, or FTS wasn't used
-                    traceback.print_exc() # Print detailed traceback for non-FTS operational errors
-                    return [] # Return empty list on error
-            except Exception as e: # Catch other potential errors
-                print(f"!!! Unexpected search error: {e}")
-                traceback.print_exc()
-                return []
+                # Plain tuples: column names are resolved once, geometry/properties are decoded by position
+                cols = [d[0] for d in cursor.description]
+                if count_in_query: cols.pop() # total_count is the last column; zip() below then leaves it out of the dicts
+                geometry_idx, properties_idx = cols.index('geometry'), cols.index('properties')
+                # Stream in batches; the list grows with the rows actually returned, not the requested limit
+                results = []
+                if count_in_query: total = 0
+                for batch in iter(lambda: cursor.fetchmany(256), []):
+                    if count_in_query: total = batch[0][-1]
+                    for row in batch:
+                        result = dict(zip(cols, row))
+                        geometry, properties = row[geometry_idx], row[properties_idx]
+                        result['geometry'] = _json_loads(geometry) if geometry else []
+                        result['properties'] = _json_loads(properties) if properties else {}
+                        results.append(result)
+                if query_params.get('fts_candidate_limit', -1) < 0 or len(results) >= limit: break
+                # Short page from capped candidates: the filters may have dropped more of them than the
+                # overfetch allowed for, so rank every match rather than silently losing results
+                query_params['fts_candidate_limit'] = -1
+            if count_in_query and not results and offset > 0:
+                # Paged past the end: no row carried the total, so count from the first page instead
+                return results, self.search_shapes(search_term, filters, use_fts, 1, 0, directory_filter, True, False)[1]
+            return (results, total) if return_total else results
+        except sqlite3.OperationalError as e:
+            if use_fts: # <-- Fallback if *any* OperationalError occurs during an FTS attempt
+                logger.warning("Database search error during FTS search (%s). Attempting fallback to standard search.", e)
+                # The recursive call passes use_fts=False, so a failing standard search cannot loop back here
+                try:
+                    logger.debug("Retrying with standard search...")
+                    # Ensure use_fts is False for the recursive call
+                    return self.search_shapes(search_term, filters, False, limit, offset, directory_filter, return_total, with_highlights)
+                except Exception as fallback_e:
+                    logger.exception("Standard search fallback also failed: %s", fallback_e)
+                    return ([], 0) if return_total else [] # Return empty on fallback failure
+            else:
+                # Error occurred even during standard search, or FTS wasn't used
+                logger.exception("Database search error: %s", e)
+                return ([], 0) if return_total else [] # Return empty list on error
+        except Exception as e: # Catch other potential errors
+            logger.exception("Unexpected search error: %s", e)
+            return ([], 0) if return_total else []
 
     def get_shape_by_id(self, shape_id: int) -> Optional[Dict[str, Any]]:
         """Get detailed information for a single shape by its ID."""
-        with self._lock:
-            conn = self._get_conn()
-            query = """ SELECT s.id as shape_id, s.name as shape_name, s.width, s.height, s.geometry, s.properties,
-                           st.name as stencil_name, st.path as stencil_path
-                        FROM shapes s JOIN stencils st ON s.stencil_path = st.path WHERE s.id = ? """
-            cursor = conn.execute(query, (shape_id,))
-            row = cursor.fetchone()
-            if not row: return None
-            shape_data = dict(row)
-            try: shape_data['geometry'] = json.loads(shape_data['geometry']) if shape_data.get('geometry') else None
-            except (json.JSONDecodeError, TypeError): shape_data['geometry'] = None
-            try: shape_data['properties'] = json.loads(shape_data['properties']) if shape_data.get('properties') else None
-            except (json.JSONDecodeError, TypeError): shape_data['properties'] = None
-            return shape_data
\ No newline at end of file
+        conn = self._get_conn()
+        query = """ SELECT s.id as shape_id, s.name as shape_name, s.width, s.height, s.geometry, s.properties,
+                       st.name as stencil_name, st.path as stencil_path
+                    FROM shapes s JOIN stencils st ON s.stencil_path = st.path WHERE s.id = ? """
+        cursor = self._row_cursor(conn).execute(query, (shape_id,))
+        row = cursor.fetchone()
+        if not row: return None
+        shape_data = dict(row)
+        # orjson's JSONDecodeError subclasses json.JSONDecodeError, so one except clause covers both decoders
+        try: shape_data['geometry'] = _json_loads(shape_data['geometry']) if shape_data.get('geometry') else None
+        except (json.JSONDecodeError, TypeError): shape_data['geometry'] = None
+        try: shape_data['properties'] = _json_loads(shape_data['properties']) if shape_data.get('properties') else None
+        except (json.JSONDecodeError, TypeError): shape_data['properties'] = None
+        return shape_data
+
+    def get_shape_bbox(self, shape_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Bounding box of a shape's geometry points (every {"x", "y"} object, at any nesting depth),
+        computed by SQLite's JSON functions so no geometry is decoded in Python. min_*/max_* are None when the shape has no geometry. None if the shape is unknown.
+        """
+        conn = self._get_conn()
+        row = conn.execute(""" SELECT s.id, s.width, s.height,
+                                      MIN(json_extract(pt.value, '$.x')), MIN(json_extract(pt.value, '$.y')),
+                                      MAX(json_extract(pt.value, '$.x')), MAX(json_extract(pt.value, '$.y'))
+                               FROM shapes s
+                               LEFT JOIN json_tree(CASE WHEN json_valid(s.geometry) THEN s.geometry END) pt ON pt.type = 'object'
+                               WHERE s.id = ? GROUP BY s.id """, (shape_id,)).fetchone()
+        if not row: return None
+        return dict(zip(('shape_id', 'width', 'height', 'min_x', 'min_y', 'max_x', 'max_y'), row))
\ No newline at end of file
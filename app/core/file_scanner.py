@@ -1,9 +1,13 @@
 import os
+import contextlib
 from datetime import datetime
 from typing import Optional
 from tqdm import tqdm
 from .db import StencilDatabase
 
+# Stencils written per cache_stencils_bulk transaction during a scan
+CACHE_BATCH_SIZE = 100
+
 # Modified to accept an external DB instance
 def scan_directory(root_dir, parser_func=None, use_cache=True, db_instance: Optional[StencilDatabase] = None):
     """
@@ -71,20 +75,25 @@ def scan_directory(root_dir, parser_func=None, use_cache=True, db_instance: Opti
     
     # First try to get from cache if enabled
     if db:
-        cached_stencils = db.get_cached_stencils()
+        # One JOIN fetches every cached stencil with its shapes, instead of a lookup per file
+        cached_stencils = {stencil['path']: stencil for stencil in db.get_cached_stencils_with_shapes()}
         if cached_stencils:
-            files_to_scan = []
+            candidate_paths = []
             for root, _, files in os.walk(root_dir):
                 for file in files:
                     if file.lower().endswith(('.vss', '.vssx', '.vssm', '.vst', '.vstx')):
-                        full_path = os.path.join(root, file)
-                        if db.needs_update(full_path):
-                            files_to_scan.append(full_path)
-                        else:
-                            # Use cached data
-                            stencil = db.get_stencil_by_path(full_path)
-                            if stencil:
-                                stencils.append(stencil)
+                        candidate_paths.append(os.path.join(root, file))
+            # Compare all mtimes against the cache in one pass rather than a DB query per file
+            stale_paths = db.needs_update_bulk(candidate_paths)
+            files_to_scan = []
+            for full_path in candidate_paths:
+                if full_path in stale_paths:
+                    files_to_scan.append(full_path)
+                else:
+                    # Use cached data
+                    stencil = cached_stencils.get(full_path)
+                    if stencil:
+                        stencils.append(stencil)
         else:
             # No cache, scan all files
             files_to_scan = []
@@ -100,32 +109,44 @@ def scan_directory(root_dir, parser_func=None, use_cache=True, db_instance: Opti
                 if file.lower().endswith(('.vss', '.vssx', '.vssm', '.vst', '.vstx')):
                     files_to_scan.append(os.path.join(root, file))
     
-    # Scan files that need updating
-    for full_path in tqdm(files_to_scan, desc="Scanning stencil files"):
-        # Default empty shapes list if no parser provided
-        shapes = []
-        if parser_func:
-            try:
-                shapes = parser_func(full_path)
-            except Exception as e:
-                print(f"Error parsing {full_path}: {str(e)}")
-                continue
-        
-        stencil_data = {
-            'path': full_path,
-            'name': os.path.splitext(os.path.basename(full_path))[0],
-            'extension': os.path.splitext(full_path)[1],
-            'shapes': shapes,
-            'shape_count': len(shapes),
-            'last_scan': scan_time.strftime("%Y-%m-%d %H:%M:%S")
-        }
-        
-        stencils.append(stencil_data)
-        
-        # Cache the stencil data if using cache
-        if db:
-            db.cache_stencil(stencil_data)
-    
+    # Scan files that need updating, caching them in batches so a long scan keeps its progress and its memory bounded
+    stencils_to_cache = []
+    # A scan without any prior cache loads everything: build the FTS index once at the end instead of per shape
+    fts_loading = db.deferred_fts_index() if db and files_to_scan and not cached_stencils else contextlib.nullcontext()
+    with fts_loading:
+        for full_path in tqdm(files_to_scan, desc="Scanning stencil files"):
+            # Default empty shapes list if no parser provided
+            shapes = []
+            if parser_func:
+                try:
+                    shapes = parser_func(full_path)
+                except Exception as e:
+                    print(f"Error parsing {full_path}: {str(e)}")
+                    continue
+
+            stencil_data = {
+                'path': full_path,
+                'name': os.path.splitext(os.path.basename(full_path))[0],
+                'extension': os.path.splitext(full_path)[1],
+                'shapes': shapes,
+                'shape_count': len(shapes),
+                'last_scan': scan_time.strftime("%Y-%m-%d %H:%M:%S")
+            }
+
+            stencils.append(stencil_data)
+
+            if db:
+                stencils_to_cache.append(stencil_data)
+                if len(stencils_to_cache) >= CACHE_BATCH_SIZE:
+                    db.cache_stencils_bulk(stencils_to_cache)
+                    stencils_to_cache = []
+
+        if db and stencils_to_cache:
+            db.cache_stencils_bulk(stencils_to_cache)
+
+    if db and files_to_scan:
+        db.post_scan_maintenance()
+
     # Close the connection only if it was created inside this function
     if db_created_internally:
         db.close()
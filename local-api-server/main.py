@@ -232,7 +232,7 @@ async def search_shapes_api(
     offset = (page - 1) * size
     try:
         search_results, total_count = db.search_shapes(
-            search_term=q, limit=size, offset=offset, use_fts=True
+            search_term=q, limit=size, offset=offset, use_fts=True, return_total=True, with_highlights=False
         )
         # Map DB dictionary keys to Pydantic model fields if needed
         response_results = [ShapeSummary(**row) for row in search_results]
@@ -250,9 +250,8 @@ async def search_shapes_api(
 async def get_stencils_api():
     """ Retrieves a summary list of all cached stencils. """
     try:
-        stencils_data = db.get_cached_stencils()
-        # Pydantic will validate the structure
-        return [StencilSummary(**stencil) for stencil in stencils_data]
+        # Pydantic will validate the structure; rows are streamed straight into the response models
+        return [StencilSummary(**stencil) for stencil in db.get_cached_stencils_iter()]
     except Exception as e:
         print(f"Error fetching stencils: {e}", file=sys.stderr)
         traceback.print_exc()
@@ -465,7 +464,7 @@ async def get_active_directory_api():
    """ Retrieves the currently active directory for stencil scanning. """
    try:
        active_dir = db.get_active_directory()
-       return active_dir
+       return dict(active_dir) if active_dir else None
    except Exception as e:
        print(f"Error fetching active directory: {e}", file=sys.stderr)
        traceback.print_exc()
@@ -510,7 +509,7 @@ async def set_active_directory_api(directory_id: int):
        if not active_dir:
            raise HTTPException(status_code=500, detail="Active directory was set but could not be retrieved.")
            
-       return active_dir
+       return dict(active_dir)
    except HTTPException as http_exc:
        raise http_exc
    except Exception as e:
@@ -598,7 +597,7 @@ async def execute_backend_command(payload: CommandPayload):
                 print(f"Scan requested for specified path: {target_path}")
             else:
                 active_dir_data = db.get_active_directory()
-                if active_dir_data and active_dir_data.get('path'):
+                if active_dir_data and active_dir_data['path']:
                     target_path = active_dir_data['path']
                     print(f"Scan requested for active preset directory: {target_path}")
                 else:
@@ -373,7 +373,8 @@ def search_stencils_db(search_term: str, filters: dict, directory_filter: Option
             filters=filters,
             use_fts=use_fts,
             limit=st.session_state.get('search_result_limit', 1000),
-            directory_filter=directory_filter
+            directory_filter=directory_filter,
+            with_highlights=False # Results are rendered from shape_name
         )
         db.close()
 
@@ -0,0 +1,629 @@
+import os
+import sqlite3
+import threading
+import pytest
+
+from app.core.db import StencilDatabase
+
+def make_stencil(dir_path, name, shapes):
+    path = os.path.join(dir_path, f"{name}.vssx")
+    with open(path, "w") as f:
+        f.write("test stencil")
+    return {
+        "path": path,
+        "name": name,
+        "extension": ".vssx",
+        "shape_count": len(shapes),
+        "shapes": shapes,
+    }
+
+@pytest.fixture
+def db(tmp_path):
+    database = StencilDatabase(db_path=str(tmp_path / "cache.db"))
+    yield database
+    database.close()
+
+def test_cache_stencil_stores_all_shapes(db, tmp_path):
+    stencil = make_stencil(str(tmp_path), "Network", [
+        "Router",
+        {"name": "Switch", "width": 2.5, "height": 1.0, "properties": {"ports": "24"}},
+        {"name": "Firewall", "geometry": [{"x": 0, "y": 0}]},
+    ])
+    db.cache_stencil(stencil)
+
+    cached = db.get_stencil_by_path(stencil["path"])
+    shapes = {s["name"]: s for s in cached["shapes"]}
+    assert set(shapes) == {"Router", "Switch", "Firewall"}
+    assert shapes["Switch"]["width"] == 2.5
+
+    switch = db.get_shape_by_id(shapes["Switch"]["shape_id"])
+    assert switch["properties"] == {"ports": "24"}
+
+def test_get_shape_bbox_reads_geometry_in_sql(db, tmp_path):
+    geometry = [[{"x": 0, "y": 1, "type": "M"}, {"x": 4, "y": -2, "type": "L"}], [{"x": -1, "y": 3, "type": "L"}]]
+    stencil = make_stencil(str(tmp_path), "Shapes", [{"name": "Poly", "width": 5, "geometry": geometry}, "Plain"])
+    db.cache_stencil(stencil)
+    ids = {s["name"]: s["shape_id"] for s in db.get_stencil_by_path(stencil["path"])["shapes"]}
+
+    bbox = db.get_shape_bbox(ids["Poly"])
+    assert (bbox["min_x"], bbox["min_y"], bbox["max_x"], bbox["max_y"]) == (-1, -2, 4, 3)
+    assert db.get_shape_by_id(ids["Poly"])["geometry"] == geometry
+    assert db.get_shape_bbox(ids["Plain"])["min_x"] is None
+    assert db.get_shape_bbox(999999) is None
+
+def test_recaching_replaces_shapes_and_fts(db, tmp_path):
+    stencil = make_stencil(str(tmp_path), "Basic", ["Rectangle", "Circle"])
+    db.cache_stencil(stencil)
+    stencil["shapes"] = ["Rectangle", "Hexagon"]
+    stencil["shape_count"] = 2
+    db.cache_stencil(stencil)
+
+    names = sorted(s["name"] for s in db.get_stencil_by_path(stencil["path"])["shapes"])
+    assert names == ["Hexagon", "Rectangle"]
+    assert [r["shape_name"] for r in db.search_shapes("Hexagon")] == ["Hexagon"]
+    assert db.search_shapes("Circle") == []
+
+def test_cache_stencil_without_shapes(db, tmp_path):
+    stencil = make_stencil(str(tmp_path), "Empty", [])
+    db.cache_stencil(stencil)
+    assert db.get_stencil_by_path(stencil["path"])["shapes"] == []
+
+def test_cache_stencils_bulk(db, tmp_path):
+    stencils = [
+        make_stencil(str(tmp_path), "Bulk1", ["Router", "Switch"]),
+        make_stencil(str(tmp_path), "Bulk2", [{"name": "Server", "width": 1.0}]),
+        {"path": str(tmp_path / "missing.vssx"), "name": "Missing", "extension": ".vssx",
+         "shape_count": 1, "shapes": ["Ghost"]},
+    ]
+    assert db.cache_stencils_bulk(stencils) == 2
+
+    assert [s["name"] for s in db.get_cached_stencils()] == ["Bulk1", "Bulk2"]
+    assert len(db.get_stencil_by_path(stencils[0]["path"])["shapes"]) == 2
+    assert [r["stencil_name"] for r in db.search_shapes("Server")] == ["Bulk2"]
+
+    # Re-caching replaces shapes rather than duplicating them
+    stencils[0]["shapes"] = ["Router"]
+    assert db.cache_stencils_bulk(stencils[:1]) == 1
+    assert [s["name"] for s in db.get_stencil_by_path(stencils[0]["path"])["shapes"]] == ["Router"]
+
+def test_fts_matches_substrings(db, tmp_path):
+    db.cache_stencil(make_stencil(str(tmp_path), "Net", ["Network Router", "Firewall"]))
+    assert [r["shape_name"] for r in db.search_shapes("out")] == ["Network Router"]
+
+def test_each_thread_gets_its_own_connection(db, tmp_path):
+    db.cache_stencil(make_stencil(str(tmp_path), "Threads", ["Router"]))
+    results = {}
+
+    def read():
+        results["conn"] = db._get_conn()
+        results["stencils"] = db.get_cached_stencils()
+
+    worker = threading.Thread(target=read)
+    worker.start()
+    worker.join()
+    assert results["conn"] is not db._get_conn()
+    assert [s["name"] for s in results["stencils"]] == ["Threads"]
+
+def test_cached_stencils_with_shapes_matches_single_lookup(db, tmp_path):
+    full = make_stencil(str(tmp_path), "Full", ["A1", "B2"])
+    empty = make_stencil(str(tmp_path), "Empty", [])
+    db.cache_stencils_bulk([full, empty])
+
+    stencils = {s["path"]: s for s in db.get_cached_stencils_with_shapes()}
+    assert stencils[empty["path"]]["shapes"] == []
+    assert stencils[full["path"]] == db.get_stencil_by_path(full["path"])
+
+def test_cached_stencils_page_walks_all_stencils(db, tmp_path):
+    db.cache_stencils_bulk([make_stencil(str(tmp_path), f"S{i}", [f"Shape{i}"]) for i in range(5)])
+
+    page, cursor = db.get_cached_stencils_page(limit=2)
+    seen = [s["name"] for s in page]
+    while cursor is not None:
+        page, cursor = db.get_cached_stencils_page(after_path=cursor, limit=2)
+        seen.extend(s["name"] for s in page)
+    assert seen == ["S0", "S1", "S2", "S3", "S4"]
+    assert all(len(s["shapes"]) == 1 for s in db.get_cached_stencils_with_shapes())
+
+def test_needs_update_bulk(db, tmp_path):
+    cached = make_stencil(str(tmp_path), "Cached", ["Router"])
+    db.cache_stencil(cached)
+    modified = make_stencil(str(tmp_path), "Modified", ["Switch"])
+    db.cache_stencil(modified)
+    os.utime(modified["path"], (os.path.getmtime(modified["path"]) + 60,) * 2)
+    new = make_stencil(str(tmp_path), "New", [])
+    missing = str(tmp_path / "missing.vssx")
+
+    paths = [cached["path"], modified["path"], new["path"], missing]
+    assert db.needs_update_bulk(paths) == {modified["path"], new["path"], missing}
+    assert {p for p in paths if db.needs_update(p)} == db.needs_update_bulk(paths)
+
+def test_duplicate_adds_are_ignored_without_errors(db, tmp_path):
+    stencil = make_stencil(str(tmp_path), "Favs", ["Router"])
+    db.cache_stencil(stencil)
+    shape_id = db.get_stencil_by_path(stencil["path"])["shapes"][0]["shape_id"]
+
+    first = db.add_favorite_stencil(stencil["path"])
+    assert db.add_favorite_stencil(stencil["path"])["id"] == first["id"]
+    assert db.add_favorite_stencil(str(tmp_path / "missing.vssx")) is None
+
+    fav = db.add_favorite_shape_by_id(stencil["path"], shape_id)
+    assert db.add_favorite_shape_by_id(stencil["path"], shape_id)["id"] == fav["id"]
+    assert db.add_favorite_shape_by_id(str(tmp_path / "other.vssx"), shape_id) is None
+
+    assert db.add_preset_directory(str(tmp_path), "Presets") is True
+    assert db.add_preset_directory(str(tmp_path), "Presets") is False
+    assert db.create_collection("Collection") is not None
+
+def test_add_favorite_returns_same_row_as_get_favorites(db, tmp_path):
+    stencil = make_stencil(str(tmp_path), "Favs", ["Router"])
+    db.cache_stencil(stencil)
+    shape_id = db.get_stencil_by_path(stencil["path"])["shapes"][0]["shape_id"]
+
+    added = [db.add_favorite_stencil(stencil["path"]), db.add_favorite_shape_by_id(stencil["path"], shape_id)]
+    assert added[0]["stencil_name"] == "Favs" and added[0]["shape_name"] is None
+    assert added[1]["stencil_name"] == "Favs" and added[1]["shape_name"] == "Router"
+    assert sorted(added, key=lambda f: f["id"]) == sorted(db.get_favorites(), key=lambda f: f["id"])
+
+def test_set_active_directory_switches_single_row(db, tmp_path):
+    db.add_preset_directory(str(tmp_path / "a"), "A")
+    db.add_preset_directory(str(tmp_path / "b"), "B")
+    ids = {d["name"]: d["id"] for d in db.get_preset_directories()}
+
+    assert db.set_active_directory(ids["A"]) is True
+    assert db.get_active_directory()["name"] == "A"
+    assert db.set_active_directory(ids["B"]) is True
+    assert [d["name"] for d in db.get_preset_directories() if d["is_active"]] == ["B"]
+    assert db.set_active_directory(9999) is False
+    assert db.get_active_directory()["name"] == "B"
+
+def test_search_shape_names_ranks_name_hits_first(db, tmp_path):
+    router_dir = tmp_path / "router"
+    router_dir.mkdir()
+    db.cache_stencil(make_stencil(str(router_dir), "Misc", ["Switch"]))
+    db.cache_stencil(make_stencil(str(tmp_path), "Network", ["Core Router"]))
+
+    results = db.search_shape_names("router", limit=5)
+    assert [r["shape_name"] for r in results] == ["Core Router", "Switch"]
+    assert db.search_shape_names("router", limit=1)[0]["shape_name"] == "Core Router"
+
+def test_search_shape_names_short_input(db, tmp_path):
+    db.cache_stencil(make_stencil(str(tmp_path), "Desk", ["PC 1", "Wi-Fi AP", "Switch"]))
+    assert [r["shape_name"] for r in db.search_shape_names("AP")] == ["Wi-Fi AP"]
+    assert [r["shape_name"] for r in db.search_shape_names("PC 1")] == ["PC 1"]
+    assert db.search_shape_names("  ") == []
+
+def test_verify_fts_rebuilds_out_of_sync_index(db, tmp_path):
+    db.cache_stencil(make_stencil(str(tmp_path), "Network", ["Router"]))
+    assert db.verify_fts() is True
+
+    conn = db._get_conn()
+    conn.execute("DROP TRIGGER shapes_ai")
+    conn.execute("INSERT INTO shapes (stencil_path, name) SELECT path, 'Firewall' FROM stencils")
+    assert db.verify_fts() is False
+    assert db.verify_fts() is True
+    assert [r["shape_name"] for r in db.search_shape_names("Firewall")] == ["Firewall"]
+
+def test_bulk_caching_refreshes_planner_statistics(db, tmp_path, monkeypatch):
+    monkeypatch.setattr("app.core.db._ANALYZE_EVERY_STENCILS", 2)
+    db.cache_stencils_bulk([make_stencil(str(tmp_path), f"S{i}", ["Router"]) for i in range(2)])
+    tables = {row[0] for row in db._get_conn().execute("SELECT tbl FROM sqlite_stat1")}
+    assert {"stencils", "shapes"} <= tables
+
+def test_favorite_sets_track_changes(db, tmp_path):
+    stencil = make_stencil(str(tmp_path), "Favs", ["Router"])
+    db.cache_stencil(stencil)
+    shape_id = db.get_stencil_by_path(stencil["path"])["shapes"][0]["shape_id"]
+    assert db.get_favorite_stencil_paths() == set()
+
+    db.add_favorite_stencil(stencil["path"])
+    db.add_favorite_shape_by_id(stencil["path"], shape_id)
+    assert db.get_favorite_stencil_paths() == {stencil["path"]}
+    assert db.get_favorite_shape_ids() == {shape_id}
+    assert db.are_favorite_shapes([shape_id, shape_id + 1]) == {shape_id}
+    assert db.are_favorite_stencils(iter([stencil["path"], "missing.vssx"])) == {stencil["path"]}
+
+    # Re-caching keeps unchanged shapes (and their favorites); a shape dropped from the stencil cascades
+    db.cache_stencil(stencil)
+    assert db.is_favorite_shape(shape_id) and db.is_favorite_stencil(stencil["path"])
+    db.cache_stencil(make_stencil(str(tmp_path), "Favs", ["Switch"]))
+    assert not db.is_favorite_shape(shape_id)
+
+    # A commit from another connection is picked up via PRAGMA data_version
+    db.add_favorite_stencil(stencil["path"])
+    assert db.is_favorite_stencil(stencil["path"])
+    other = sqlite3.connect(str(db.db_path))
+    with other:
+        other.execute("DELETE FROM favorites")
+    other.close()
+    assert not db.is_favorite_stencil(stencil["path"])
+
+def test_clear_cache_empties_fts_and_keeps_triggers(db, tmp_path):
+    db.cache_stencils_bulk([make_stencil(str(tmp_path), f"S{i}", ["Router", "Switch"]) for i in range(3)])
+    db.clear_cache()
+    assert db.get_cached_stencils() == []
+    assert db.search_shape_names("Router") == []
+    assert db.verify_fts() is True
+
+    db.cache_stencil(make_stencil(str(tmp_path), "Again", ["Router"]))
+    db.cache_stencil(make_stencil(str(tmp_path), "Again", ["Hub"]))
+    assert db.search_shape_names("Router") == []
+    assert db.verify_fts() is True
+
+    # The collection trigger is restored as well
+    coll_id = db.create_collection("Kept")["id"]
+    hub_id = db.get_cached_stencils_with_shapes()[0]["shapes"][0]["shape_id"]
+    db.add_shape_to_collection(coll_id, hub_id)
+    db.remove_shape_from_collection(coll_id, hub_id)
+    assert [c["shape_count"] for c in db.get_collections()] == [0]
+
+def test_integrity_check_runs_only_when_due(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "cache.db")
+    StencilDatabase(db_path=db_path).close()
+    checks = []
+    monkeypatch.setattr(StencilDatabase, "_check_integrity", lambda self, full=False: checks.append(full) or True)
+
+    StencilDatabase(db_path=db_path).close()
+    assert checks == []
+    StencilDatabase(db_path=db_path, check_integrity=True).close()
+    assert checks == [True]
+
+def test_saved_search_filters_round_trip(db):
+    filters = {"extensions": [".vssx", ".vss"], "min_shapes": 1, "max_size": 2.5, "term": "x", "show_favorites": True}
+    db.add_saved_search("Basic", "router", filters)
+    db.add_saved_search("Empty", "", {})
+    db.add_saved_search("Basic", "other", {})
+
+    searches = {s["name"]: s for s in db.get_saved_searches()}
+    assert searches["Basic"]["filters"] == filters
+    assert searches["Basic"]["filters"]["show_favorites"] is True
+    assert searches["Basic"]["search_term"] == "router"
+    assert searches["Empty"]["filters"] == {}
+
+    db.delete_saved_search(searches["Basic"]["id"])
+    assert [s["name"] for s in db.get_saved_searches()] == ["Empty"]
+    assert db._get_conn().execute("SELECT COUNT(*) FROM saved_search_filters").fetchone()[0] == 0
+
+
+def test_saved_search_filters_backfilled_from_json(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    db = StencilDatabase(db_path=db_path)
+    db._get_conn().execute("INSERT INTO saved_searches (name, search_term, filters) VALUES ('Old', 't', ?)",
+                           ('{"min_shapes": 3, "extensions": [".vss"], "show_favorites": false}',))
+    db.close()
+
+    db = StencilDatabase(db_path=db_path)
+    try:
+        filters = db.get_saved_searches()[0]["filters"]
+        assert filters == {"min_shapes": 3, "extensions": [".vss"], "show_favorites": False}
+        assert filters["show_favorites"] is False
+    finally:
+        db.close()
+
+def test_search_shapes_applies_filters_to_fts_candidates(db, tmp_path):
+    db.cache_stencil(make_stencil(str(tmp_path), "Small", ["Router"]))
+    db.cache_stencil(make_stencil(str(tmp_path), "Large", ["Router", "Core Router", "Edge Router"]))
+
+    results = db.search_shapes("Router", filters={"min_shapes": 2}, use_fts=True, limit=5)
+    assert {r["stencil_name"] for r in results} == {"Large"}
+    assert len(results) == 3
+    assert all("[HL]" in r["highlighted_name"] for r in results)
+    assert len(db.search_shapes("Router", use_fts=True, limit=5)) == 4
+
+def test_search_shapes_filtered_fts_page_survives_capped_candidates(db, tmp_path):
+    # More better-ranked matches fail the filter than limit * _FTS_FILTER_OVERFETCH candidates allow for
+    db.cache_stencil(make_stencil(str(tmp_path), "Many", [f"Router {i}" for i in range(15)]))
+    db.cache_stencil(make_stencil(str(tmp_path), "Few", ["Long Redundant Edge Router Variant"]))
+
+    results = db.search_shapes("Router", filters={"max_shapes": 2}, use_fts=True, limit=1)
+    assert [r["shape_name"] for r in results] == ["Long Redundant Edge Router Variant"]
+    assert db.search_shapes("Router", filters={"max_shapes": 2}, use_fts=True, limit=1, offset=1) == []
+
+def test_fts_table_without_id_column_is_migrated(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    db = StencilDatabase(db_path=db_path)
+    db.cache_stencil(make_stencil(str(tmp_path), "Network", ["Router"]))
+    conn = db._get_conn()
+    conn.execute("DROP TABLE shapes_fts")
+    conn.execute("""CREATE VIRTUAL TABLE shapes_fts USING fts5(
+        id, name, stencil_path, content='shapes', content_rowid='id', tokenize='trigram')""")
+    db.close()
+
+    db = StencilDatabase(db_path=db_path)
+    try:
+        columns = [row[1] for row in db._get_conn().execute("PRAGMA table_info(shapes_fts)")]
+        assert columns == ["name", "stencil_path"]
+        assert [r["shape_name"] for r in db.search_shape_names("outer")] == ["Router"]
+        assert db.search_shapes("Rout", use_fts=True)[0]["highlighted_name"] == "[HL]Rout[/HL]er"
+    finally:
+        db.close()
+
+def test_search_shapes_highlights_full_name(db, tmp_path):
+    long_name = "Cisco Catalyst 9300 Series Multilayer Access Switch With Uplink Module"
+    db.cache_stencil(make_stencil(str(tmp_path), "Cisco", [long_name]))
+    result = db.search_shapes("Uplink", use_fts=True)[0]
+    assert result["highlighted_name"] == long_name.replace("Uplink", "[HL]Uplink[/HL]")
+    for filters in (None, {"min_shapes": 1}):
+        plain = db.search_shapes("Uplink", filters=filters, use_fts=True, with_highlights=False)
+        assert [(r["shape_name"], r["highlighted_name"]) for r in plain] == [(long_name, None)]
+
+def test_search_shapes_substring_and_empty_term(db, tmp_path):
+    db.cache_stencil(make_stencil(str(tmp_path), "Network", ["Core Router", "Switch", "Hub"]))
+
+    assert [r["shape_name"] for r in db.search_shapes("OUTE", use_fts=False)] == ["Core Router"]
+    assert [r["shape_name"] for r in db.search_shapes("ub", use_fts=False)] == ["Hub"]
+    assert [r["shape_name"] for r in db.search_shapes("ub", use_fts=True)] == ["Hub"]
+    assert [r["shape_name"] for r in db.search_shapes("", use_fts=True)] == ["Core Router", "Hub", "Switch"]
+
+def test_search_shapes_short_word_in_multi_word_term(db, tmp_path):
+    db.cache_stencil(make_stencil(str(tmp_path), "Desk", ["PC 1", "PC 2", "Core Router"]))
+
+    for use_fts in (True, False):
+        assert [r["shape_name"] for r in db.search_shapes("PC 1", use_fts=use_fts)] == ["PC 1"]
+        assert [r["shape_name"] for r in db.search_shapes("re Ro", use_fts=use_fts)] == ["Core Router"]
+
+@pytest.mark.parametrize("filter_clauses", [(), ("st.shape_count >= :min_shapes",)])
+def test_fts_search_plan_orders_inside_fts5(db, filter_clauses):
+    from app.core.db import _build_search_query
+    params = {"search_term_fts": "rou", "limit": 5, "offset": 0, "fts_candidate_limit": 50, "min_shapes": 1}
+    plan = [row[3] for row in db._get_conn().execute("EXPLAIN QUERY PLAN " + _build_search_query("fts", filter_clauses), params)]
+    # 'M' + ORDER BY rank consumed by FTS5 (no sort of the full match list); a temp b-tree may
+    # only sort the bounded, already-ranked candidates of the filtered CTE.
+    assert any("VIRTUAL TABLE INDEX 32:M" in step for step in plan)
+    assert ("USE TEMP B-TREE FOR ORDER BY" in plan) == bool(filter_clauses)
+
+def test_recreate_tables_backs_up_committed_data(tmp_path):
+    db = StencilDatabase(db_path=str(tmp_path / "cache.db"))
+    try:
+        db.cache_stencil(make_stencil(str(tmp_path), "Network", ["Router"]))
+        assert db._recreate_tables() is True
+        backups = list(tmp_path.glob("cache.db.backup.*"))
+        assert len(backups) == 1
+        backup = sqlite3.connect(str(backups[0]))
+        assert backup.execute("SELECT name FROM shapes").fetchall() == [("Router",)]
+        backup.close()
+        assert db.get_cached_stencils() == []
+    finally:
+        db.close()
+
+def test_cache_stencils_bulk_with_fts_rebuild(db, tmp_path):
+    db.cache_stencil(make_stencil(str(tmp_path), "Existing", ["Hub"]))
+    count = db.cache_stencils_bulk([make_stencil(str(tmp_path), f"S{i}", ["Router"]) for i in range(3)], rebuild_fts=True)
+    assert count == 3
+    assert db.verify_fts() is True
+    assert len(db.search_shape_names("Router")) == 3
+    triggers = {row[0] for row in db._get_conn().execute("SELECT name FROM sqlite_master WHERE type='trigger'")}
+    assert {"shapes_ai", "shapes_ad", "shapes_au"} <= triggers
+
+def test_cached_stencils_iter_pages_in_sql(db, tmp_path):
+    db.cache_stencils_bulk([make_stencil(str(tmp_path), name, []) for name in ("C", "A", "B")])
+    assert [s["name"] for s in db.get_cached_stencils_iter()] == ["A", "B", "C"]
+    assert [s["name"] for s in db.get_cached_stencils_iter(limit=1, offset=1)] == ["B"]
+    assert db.count_cached_stencils() == 3
+    assert db.get_cached_stencils() == list(db.get_cached_stencils_iter())
+
+def test_collection_shape_count_tracks_memberships(db, tmp_path):
+    stencil = make_stencil(str(tmp_path), "Net", ["Router", "Switch", "Hub"])
+    db.cache_stencil(stencil)
+    shape_ids = [s["shape_id"] for s in db.get_stencil_by_path(stencil["path"])["shapes"]]
+    coll_id = db.create_collection("Core")["id"]
+
+    db.update_collection(coll_id, add_shape_ids=shape_ids)
+    db.add_shape_to_collection(coll_id, shape_ids[0]) # already present: no double count
+    assert db.add_shape_to_collection(coll_id, 999999) is False
+    assert db.add_shape_to_collection(999999, shape_ids[0]) is False
+    db.remove_shape_from_collection(coll_id, shape_ids[1])
+    assert [c["shape_count"] for c in db.get_collections()] == [2]
+
+    db.cache_stencil(make_stencil(str(tmp_path), "Net", ["Switch", "Hub"])) # Router's membership cascades away
+    assert [c["shape_count"] for c in db.get_collections()] == [len(db.get_collection_details(coll_id)["shapes"])]
+
+def test_recache_updates_shapes_in_place(db, tmp_path):
+    db.cache_stencil(make_stencil(str(tmp_path), "Net", ["Router", "Switch"]))
+    path = db.get_cached_stencils()[0]["path"]
+    ids = {s["name"]: s["shape_id"] for s in db.get_stencil_by_path(path)["shapes"]}
+
+    db.cache_stencils_bulk([make_stencil(str(tmp_path), "Net", ["Router", "Hub"])])
+    after = {s["name"]: s["shape_id"] for s in db.get_stencil_by_path(path)["shapes"]}
+    assert set(after) == {"Router", "Hub"} and after["Router"] == ids["Router"]
+    assert [r["shape_name"] for r in db.search_shapes("Hub", use_fts=True)] == ["Hub"]
+    assert db.search_shapes("Switch", use_fts=True) == []
+    assert db.verify_fts()
+
+def test_transaction_rolls_back_on_error(db, tmp_path):
+    conn = db._get_conn()
+    with pytest.raises(RuntimeError):
+        with db._transaction(conn):
+            conn.execute("INSERT INTO preset_directories (path, name) VALUES (?, ?)", (str(tmp_path), "Tmp"))
+            raise RuntimeError("boom")
+    assert not conn.in_transaction
+    assert db.get_preset_directories() == []
+
+def test_post_scan_maintenance_truncates_wal(db, tmp_path):
+    db.cache_stencils_bulk([make_stencil(str(tmp_path), f"S{i}", ["Router", "Switch"]) for i in range(20)])
+    wal_path = f"{db.db_path}-wal"
+    assert os.path.getsize(wal_path) > 0
+    db.post_scan_maintenance()
+    assert os.path.getsize(wal_path) == 0
+    assert db.count_cached_stencils() == 20
+
+def test_update_collection_skips_unknown_shapes(db, tmp_path):
+    stencil = make_stencil(str(tmp_path), "Net", ["Router", "Switch"])
+    db.cache_stencil(stencil)
+    shape_ids = [s["shape_id"] for s in db.get_stencil_by_path(stencil["path"])["shapes"]]
+    coll_id = db.create_collection("Core")["id"]
+
+    details = db.update_collection(coll_id, name="Renamed", add_shape_ids=shape_ids + [999999])
+    assert details["name"] == "Renamed"
+    assert sorted(s["shape_id"] for s in details["shapes"]) == sorted(shape_ids)
+    details = db.update_collection(coll_id, remove_shape_ids=shape_ids[:1])
+    assert [s["shape_id"] for s in details["shapes"]] == shape_ids[1:]
+    assert db.update_collection(999999, name="Missing") is None
+
+    # A rename onto an existing name fails as a whole: the shape change in the same call is rolled back
+    db.create_collection("Taken")
+    assert db.update_collection(coll_id, name="Taken", add_shape_ids=shape_ids[:1]) is None
+    details = db.get_collection_details(coll_id)
+    assert details["name"] == "Renamed" and [s["shape_id"] for s in details["shapes"]] == shape_ids[1:]
+
+def test_fresh_database_is_stamped_with_schema_version(tmp_path, caplog):
+    from app.core.db import _SCHEMA_VERSION
+    database = StencilDatabase(db_path=str(tmp_path / "fresh.db"))
+    try:
+        assert database._get_conn().execute("PRAGMA user_version").fetchone()[0] == _SCHEMA_VERSION
+        assert "Error running migrations" not in caplog.text
+    finally:
+        database.close()
+
+@pytest.mark.parametrize("use_fts, filters", [(True, None), (True, {"min_shapes": 1}), (False, None)])
+def test_search_shapes_return_total_counts_all_matches(db, tmp_path, use_fts, filters):
+    db.cache_stencil(make_stencil(str(tmp_path), "Net", [f"Router {i}" for i in range(5)] + ["Switch"]))
+
+    page, total = db.search_shapes("Router", filters=filters, use_fts=use_fts, limit=2, return_total=True)
+    assert len(page) == 2 and total == 5
+    assert "total_count" not in page[0]
+    assert db.search_shapes("Router", filters=filters, use_fts=use_fts, limit=2, offset=10, return_total=True) == ([], 5)
+    assert len(db.search_shapes("Router", filters=filters, use_fts=use_fts, limit=2)) == 2
+
+def test_add_shapes_to_collection_in_bulk(db, tmp_path):
+    stencil = make_stencil(str(tmp_path), "Net", ["Router", "Switch", "Hub"])
+    db.cache_stencil(stencil)
+    shape_ids = [s["shape_id"] for s in db.get_stencil_by_path(stencil["path"])["shapes"]]
+    coll_id = db.create_collection("Bulk")["id"]
+
+    assert db.add_shapes_to_collection(coll_id, shape_ids[:2] + [999999]) == 2
+    assert db.add_shapes_to_collection(coll_id, shape_ids) == 1
+    assert db.add_shapes_to_collection(999999, shape_ids) == 0
+    assert [c["shape_count"] for c in db.get_collections()] == [3]
+
+def test_recover_database_keeps_readable_data(db, tmp_path):
+    stencil = make_stencil(str(tmp_path), "Net", ["Router", "Switch"])
+    db.cache_stencil(stencil)
+    coll_id = db.create_collection("Kept")["id"]
+    db.add_shape_to_collection(coll_id, db.get_stencil_by_path(stencil["path"])["shapes"][0]["shape_id"])
+
+    assert db._recover_database() is True
+    assert [r["shape_name"] for r in db.search_shapes("Router")] == ["Router"]
+    assert [(c["name"], c["shape_count"]) for c in db.get_collections()] == [("Kept", 1)]
+    assert db.verify_fts()
+
+def test_search_shapes_lists_all_with_cached_total(db, tmp_path):
+    db.cache_stencil(make_stencil(str(tmp_path), "Net", ["Router", "Switch"]))
+    assert db.search_shapes("", limit=1, return_total=True)[1] == 2
+    assert db.search_shapes("", limit=1, offset=5, return_total=True) == ([], 2)
+
+    db.cache_stencil(make_stencil(str(tmp_path), "More", ["Hub"]))
+    page, total = db.search_shapes("", limit=10, return_total=True)
+    assert total == 3 and [r["shape_name"] for r in page] == ["Hub", "Router", "Switch"]
+
+def test_search_shapes_quotes_fts_syntax_in_plain_terms(db, tmp_path, caplog):
+    db.cache_stencil(make_stencil(str(tmp_path), "Rack", ['19" Rack Shelf', "Wi-Fi AP", "Patch Panel"]))
+
+    assert [r["shape_name"] for r in db.search_shapes('19" Rack')] == ['19" Rack Shelf']
+    assert [r["shape_name"] for r in db.search_shapes("Wi-Fi")] == ["Wi-Fi AP"]
+    assert {r["shape_name"] for r in db.search_shapes("(Shelf OR Panel)")} == {'19" Rack Shelf', "Patch Panel"}
+    assert "fallback" not in caplog.text
+
+def test_stamped_older_schema_is_migrated(tmp_path):
+    from app.core.db import _SCHEMA_VERSION
+    db_path = str(tmp_path / "old.db")
+    database = StencilDatabase(db_path=db_path)
+    conn = database._get_conn()
+    old_indexes = {"idx_shapes_name_stencil_path": "shapes(name, stencil_path)",
+                   "idx_collections_name": "collections(name)", "idx_saved_searches_name": "saved_searches(name)"}
+    for name, columns in old_indexes.items():
+        conn.execute(f"CREATE INDEX {name} ON {columns}")
+    conn.execute("PRAGMA user_version = 1")
+    database.close()
+
+    database = StencilDatabase(db_path=db_path)
+    try:
+        conn = database._get_conn()
+        assert not {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")} & set(old_indexes)
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == _SCHEMA_VERSION
+    finally:
+        database.close()
+
+def test_scan_directory_caches_in_batches(db, tmp_path, monkeypatch):
+    from app.core import file_scanner
+    for i in range(5):
+        (tmp_path / f"Stencil{i}.vssx").write_text("test stencil")
+    monkeypatch.setattr(file_scanner, "CACHE_BATCH_SIZE", 2)
+    calls = []
+    real_bulk = db.cache_stencils_bulk
+    monkeypatch.setattr(db, "cache_stencils_bulk", lambda stencils, **kw: calls.append(len(stencils)) or real_bulk(stencils, **kw))
+
+    file_scanner.scan_directory(str(tmp_path), parser_func=lambda path: ["Router"], db_instance=db)
+
+    assert calls == [2, 2, 1]
+    assert len(db.search_shapes("Router", limit=10)) == 5
+    assert db.verify_fts()
+
+def test_missing_fts_triggers_are_restored_with_a_rebuild(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    database = StencilDatabase(db_path=db_path)
+    conn = database._get_conn()
+    conn.execute("DROP TRIGGER shapes_ai") # As left behind by an interrupted deferred_fts_index() load
+    database.cache_stencil(make_stencil(str(tmp_path), "Net", ["Router"]))
+    assert database.search_shapes("Router") == []
+    database.close()
+
+    database = StencilDatabase(db_path=db_path)
+    try:
+        assert [r["shape_name"] for r in database.search_shapes("Router")] == ["Router"]
+    finally:
+        database.close()
+
+def test_iso_last_modified_is_migrated_to_unix_seconds(tmp_path):
+    from datetime import datetime
+    db_path = str(tmp_path / "cache.db")
+    database = StencilDatabase(db_path=db_path)
+    stencil = make_stencil(str(tmp_path), "Net", ["Router"])
+    database.cache_stencil(stencil)
+    mtime = int(os.stat(stencil["path"]).st_mtime)
+    conn = database._get_conn()
+    conn.execute("UPDATE stencils SET last_modified = ?", (datetime.fromtimestamp(mtime).isoformat(),))
+    conn.execute("PRAGMA user_version = 3")
+    database.close()
+
+    database = StencilDatabase(db_path=db_path)
+    try:
+        assert database._get_conn().execute("SELECT last_modified FROM stencils").fetchone()[0] == mtime
+        assert not database.needs_update(stencil["path"])
+        assert database.get_stencil_by_path(stencil["path"])["last_modified"] == datetime.fromtimestamp(mtime).isoformat()
+    finally:
+        database.close()
+
+def test_search_date_filters_compare_unix_seconds(db, tmp_path):
+    from datetime import date, timedelta
+    db.cache_stencil(make_stencil(str(tmp_path), "Net", ["Router"]))
+    today = date.fromtimestamp(os.stat(tmp_path / "Net.vssx").st_mtime)
+
+    assert len(db.search_shapes("Router", filters={"date_start": today, "date_end": today})) == 1
+    assert db.search_shapes("Router", filters={"date_start": today + timedelta(days=1)}) == []
+    assert db.search_shapes("Router", filters={"date_end": today - timedelta(days=1)}) == []
+
+def test_failed_migration_is_rolled_back_and_retried(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    database = StencilDatabase(db_path=db_path)
+    database.cache_stencil(make_stencil(str(tmp_path), "Net", ["Router"]))
+    conn = database._get_conn()
+    conn.execute("CREATE INDEX idx_collections_name ON collections(name)")
+    conn.execute("UPDATE stencils SET last_modified = '2024-01-01T00:00:00'")
+    conn.execute("CREATE TRIGGER block_mtime BEFORE UPDATE ON stencils BEGIN SELECT RAISE(ABORT, 'blocked'); END")
+    conn.execute("PRAGMA user_version = 3")
+    database.close()
+
+    database = StencilDatabase(db_path=db_path)
+    conn = database._get_conn()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 3
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_collections_name'").fetchone() # Rolled back
+    conn.execute("DROP TRIGGER block_mtime")
+    database.close()
+
+    database = StencilDatabase(db_path=db_path)
+    try:
+        conn = database._get_conn()
+        assert conn.execute("SELECT typeof(last_modified) FROM stencils").fetchone()[0] == "integer"
+        assert not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_collections_name'").fetchone()
+    finally:
+        database.close()